@@ -1,13 +1,15 @@
-import os, io, json, threading, datetime, time, shutil
-from urllib.parse import quote_plus
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, session, send_from_directory
+import os, io, json, threading, datetime, time, shutil, uuid, hmac
+from functools import lru_cache
+from urllib.parse import quote, quote_plus
+from flask import Flask, Response, render_template, request, jsonify, send_file, redirect, url_for, session, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import text
+from werkzeug.security import safe_join
 from dotenv import load_dotenv
-import pandas as pd
+from argon2 import PasswordHasher, extract_parameters
+from argon2.exceptions import VerificationError, InvalidHashError
 import csv
 from io import StringIO
-from flask import make_response
 # AI Model Logic (imported from your model.py)
 from model import train_model_background, extract_embedding_for_image, load_model_if_exists
 
@@ -16,15 +18,42 @@ load_dotenv()
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.secret_key = os.getenv("SECRET_KEY", "admin_access_key_123")
 
+# --- ADMIN CREDENTIALS ---
+# Preferred: ADMIN_PW_HASH (argon2). ADMIN_PASSWORD is a plaintext fallback for older .env files.
+ADMIN_PW_HASH = os.getenv("ADMIN_PW_HASH")
+ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")
+_password_hasher = PasswordHasher()
+if ADMIN_PW_HASH:
+    try:
+        extract_parameters(ADMIN_PW_HASH)
+    except InvalidHashError:
+        # check_admin_password() can only ever fail against this; say why once, up front
+        print("[AUTH] ADMIN_PW_HASH is not a valid argon2 hash - admin login will be refused (see README)")
+
 # --- DATABASE CONFIGURATION ---
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_USER = os.getenv("DB_USER", "root")
 DB_PASSWORD = quote_plus(os.getenv("DB_PASSWORD", ""))
 DB_NAME = os.getenv("DB_NAME", "attendance_db")
 DB_PORT = os.getenv("DB_PORT", "3306")
-
-app.config["SQLALCHEMY_DATABASE_URI"] = f"mysql+mysqlconnector://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# On-device MySQL: talk over its Unix socket instead of loopback TCP (mysqlclient already does
+# this for DB_HOST=localhost; set it when the host is 127.0.0.1 or the socket path is non-standard)
+DB_SOCKET = os.getenv("DB_SOCKET")
+
+# mysqlclient (C, libmariadb) materializes rows much faster than the pure-Python connector
+app.config["SQLALCHEMY_DATABASE_URI"] = f"mysql+mysqldb://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?charset=utf8mb4"
+if DB_SOCKET:
+    app.config["SQLALCHEMY_DATABASE_URI"] += f"&unix_socket={quote_plus(DB_SOCKET)}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Camera thread + dashboard requests share the pool; pre_ping/recycle survive MySQL's idle timeout.
+# Sized for the real concurrency (4 waitress threads, the attendance writer, name lookups)
+# rather than holding 20+ idle MySQL connections open
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 10,
+    "max_overflow": 5,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+}
 db = SQLAlchemy(app)
 
 # --- FILE PATHS ---
@@ -33,19 +62,120 @@ DATASET_DIR = os.path.join(APP_DIR, "dataset")
 TRAIN_STATUS_FILE = os.path.join(APP_DIR, "train_status.json")
 os.makedirs(DATASET_DIR, exist_ok=True)
 
+# When running behind Nginx, dataset images are handed off via X-Accel-Redirect
+# (e.g. DATASET_ACCEL_PREFIX=/internal/dataset with an `internal` alias to dataset/)
+DATASET_ACCEL_PREFIX = os.getenv("DATASET_ACCEL_PREFIX", "").rstrip("/")
+DATASET_IMAGE_MAX_AGE = 3600
+
 # --- HELPER FUNCTIONS ---
 
-def write_train_status(data):
-    """Writes the current AI training progress to a JSON file for the frontend to read."""
-    with open(TRAIN_STATUS_FILE, "w") as f:
-        json.dump(data, f)
+def write_file_bytes(path, data):
+    """Writes raw bytes with a single open/write/close, bypassing Werkzeug's buffered save."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def check_admin_password(password):
+    """Verifies the admin password against the argon2 hash, or in constant time against the plaintext fallback."""
+    if not password:
+        return False
+    if ADMIN_PW_HASH:
+        try:
+            return _password_hasher.verify(ADMIN_PW_HASH, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return hmac.compare_digest(password.encode(), ADMIN_PASSWORD.encode())
+
+@lru_cache(maxsize=32)
+def list_dataset_images(folder_path, mtime_ns):
+    """Sorted image names in a student folder. mtime_ns is part of the cache key, so adds/deletes invalidate it."""
+    # scandir yields dirents (type included), so no extra stat per image
+    with os.scandir(folder_path) as it:
+        return tuple(sorted(e.name for e in it if e.is_file() and e.name.lower().endswith(('.jpg', '.jpeg', '.png'))))
+
+# Training progress lives in memory for the polling dashboard; the JSON file only carries
+# start/end states, and model.py's final result back from train_model_background
+_train_status = {"running": False, "progress": 0, "message": "Idle"}
+_train_status_lock = threading.Lock()
+
+def write_train_status(data, persist=True):
+    """Updates the current AI training progress. Also snapshots it to disk when persist is True."""
+    with _train_status_lock:
+        _train_status.clear()
+        _train_status.update(data)
+    if persist:
+        with open(TRAIN_STATUS_FILE, "w") as f:
+            json.dump(data, f)
 
 def read_train_status():
-    """Reads the current AI training progress. Returns idle status if file doesn't exist."""
-    if not os.path.exists(TRAIN_STATUS_FILE):
-        return {"running": False, "progress": 0, "message": "Idle"}
-    with open(TRAIN_STATUS_FILE, "r") as f:
-        return json.load(f)
+    """Returns a copy of the current AI training progress for the frontend."""
+    with _train_status_lock:
+        return dict(_train_status)
+
+def run_training_job():
+    """
+    Runs model training and mirrors the final status written by model.py back into memory.
+    Whatever happens, the job ends with running=False, so the dashboard never polls forever.
+    """
+    write_train_status({"running": True, "progress": 0, "message": "Starting..."})
+    final = {"running": False, "progress": 0, "message": "Failed: training stopped unexpectedly"}
+    try:
+        train_model_background(
+            DATASET_DIR,
+            lambda p, m: write_train_status({"running": True, "progress": p, "message": m}, persist=False)
+        )
+        with open(TRAIN_STATUS_FILE, "r") as f:
+            final = json.load(f)
+    except Exception as e:
+        print(f"[TRAIN ERROR] {e}")
+        final = {"running": False, "progress": 0, "message": f"Failed: {e}"}
+    finally:
+        write_train_status(final)
+
+# Student names change only on enroll/delete, so recognition reads them from memory
+USER_NAMES_SQL = text("SELECT user_id, name FROM users")
+USER_NAME_SQL = text("SELECT name FROM users WHERE user_id = :sid")
+_user_name_cache = {}
+_user_name_cache_loaded = False
+_user_name_lock = threading.Lock()
+
+def load_user_names():
+    """Fills the name cache with every user in one query (done once, lazily or at camera start)."""
+    global _user_name_cache_loaded
+    with _user_name_lock:
+        if not _user_name_cache_loaded:
+            try:
+                rows = db.session.execute(USER_NAMES_SQL).fetchall()
+            finally:
+                # The camera thread's app context never ends; return the connection (rolled back) to
+                # the pool so it isn't held in an open transaction past MySQL's wait_timeout
+                db.session.remove()
+            _user_name_cache.update({r[0]: r[1] for r in rows})
+            _user_name_cache_loaded = True
+
+_MISSING = object()
+
+def get_user_name(student_id):
+    """Returns a student's name from the in-process cache, falling back to a single SELECT on a miss."""
+    if not _user_name_cache_loaded:
+        load_user_names()
+    # A single dict lookup is atomic under the GIL, so hits (every recognised frame) take no lock.
+    # None is cached too: a model class with no users row would otherwise cost a SELECT per frame
+    name = _user_name_cache.get(student_id, _MISSING)
+    if name is not _MISSING:
+        return name
+    try:
+        res = db.session.execute(USER_NAME_SQL, {"sid": student_id}).fetchone()
+    finally:
+        db.session.remove() # As in load_user_names(): don't keep a connection checked out
+    name = res[0] if res else None
+    with _user_name_lock:
+        _user_name_cache[student_id] = name
+    return name
 
 # Initialize the status file so the app doesn't crash on first load
 write_train_status({"running": False, "progress": 0, "message": "Ready"})
@@ -57,21 +187,36 @@ def index():
     """Renders the main dashboard homepage."""
     return render_template("index.html")
 
+ATTENDANCE_STATS_SQL = text(
+    "SELECT DATE(timestamp) AS d, COUNT(*) AS c FROM attendance "
+    "WHERE timestamp >= DATE_SUB(CURDATE(), INTERVAL 29 DAY) "
+    "GROUP BY DATE(timestamp)"
+)
+
 @app.route("/attendance_stats")
 def attendance_stats():
     """Fetches attendance data for the last 30 days to populate the dashboard chart."""
     try:
-        df = pd.read_sql(text("SELECT timestamp FROM attendance"), db.engine)
+        # Let MySQL bucket the rows per day; only the last 30 days ever leave the DB
+        rows = db.session.execute(ATTENDANCE_STATS_SQL).fetchall()
         today = datetime.date.today()
         days = [today - datetime.timedelta(days=i) for i in range(29, -1, -1)]
-        df["date"] = pd.to_datetime(df["timestamp"]).dt.date
-        counts = [(df["date"] == d).sum() for d in days]
+        # Bucket by day offset in one pass (guard against app/DB clock skew at the edges)
+        counts = [0] * 30
+        for d, c in rows:
+            offset = (today - d).days
+            if 0 <= offset < 30:
+                counts[29 - offset] = int(c)
         return jsonify({"dates": [d.strftime("%d-%b") for d in days], "counts": [int(c) for c in counts]})
     except:
         return jsonify({"dates": [], "counts": []})
 
 # --- STUDENT ENROLLMENT & FACE UPLOAD ---
 
+ADD_STUDENT_SQL = text(
+    "INSERT INTO users (user_id, name, class, section, role, created_at) VALUES (:id, :n, :c, :s, 'student', NOW())"
+)
+
 @app.route("/enrollment", methods=["GET", "POST"])
 def add_student():
     """Handles new student registration (Step 1: Text Data)."""
@@ -81,13 +226,17 @@ def add_student():
     name = request.form.get("name")
     s_class = request.form.get("class")
     s_section = request.form.get("section")
-    student_id = f"S{int(time.time() * 1000)}" # Generate unique ID based on timestamp
+    student_id = f"S{uuid.uuid4().hex[:12]}" # Random ID; can't collide like a per-ms timestamp could
     
     try:
-        db.session.execute(text("INSERT INTO users (user_id, name, class, section, role, created_at) VALUES (:id, :n, :c, :s, 'student', NOW())"),
-            {"id": student_id, "n": name, "c": s_class, "s": s_section})
-        db.session.commit()
-        os.makedirs(os.path.join(DATASET_DIR, student_id), exist_ok=True)
+        # Core transaction, no ORM session: commits on exit, rolls back if anything raises.
+        # The id is generated here, so one INSERT + COMMIT is the whole exchange (no lastrowid read-back)
+        with db.engine.begin() as conn:
+            conn.execute(ADD_STUDENT_SQL, {"id": student_id, "n": name, "c": s_class, "s": s_section})
+            # Folder first, commit last: a committed student always has a dataset folder
+            os.makedirs(os.path.join(DATASET_DIR, student_id), exist_ok=True)
+        with _user_name_lock:
+            _user_name_cache[student_id] = name
         return jsonify({"status": "success", "student_id": student_id})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -105,8 +254,9 @@ def upload_face():
     
     saved = 0
     for f in files:
-        filename = f"{int(time.time() * 1000)}_{saved}.jpg"
-        f.save(os.path.join(folder, filename))
+        # ns timestamp keeps admin view ordering; the uuid suffix rules out collisions between uploads
+        filename = f"{time.time_ns()}_{uuid.uuid4().hex[:8]}.jpg"
+        write_file_bytes(os.path.join(folder, filename), f.read())
         saved += 1
     return jsonify({"success": True, "saved": saved})
 
@@ -116,11 +266,7 @@ def upload_face():
 def train_model_api():
     """Triggers the background AI training process from the homepage/dashboard."""
     # Start the training function in model.py using a background thread
-    threading.Thread(
-        target=train_model_background, 
-        args=(DATASET_DIR, lambda p, m: write_train_status({"running":True,"progress":p,"message":m})), 
-        daemon=True
-    ).start()
+    threading.Thread(target=run_training_job, daemon=True).start()
     return jsonify({"status": "started"})
 
 @app.route("/train_status")
@@ -134,7 +280,7 @@ def train_status():
 def admin_login():
     """Handles admin authentication."""
     if request.method == "POST":
-        if request.form.get("password") == "admin123":
+        if check_admin_password(request.form.get("password")):
             session['admin_logged_in'] = True
             return redirect(url_for('admin_directory'))
     return render_template("login.html")
@@ -145,52 +291,82 @@ def admin_logout():
     session.pop('admin_logged_in', None)
     return redirect(url_for('admin_login'))
 
+STUDENT_DIRECTORY_SQL = text("SELECT user_id, name, class, section FROM users WHERE role = 'student'")
+
 @app.route("/admin/directory")
 def admin_directory():
     """Displays a list of all registered students."""
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
-    students = db.session.execute(text("SELECT user_id, name, class, section FROM users WHERE role = 'student'")).fetchall()
+    students = db.session.execute(STUDENT_DIRECTORY_SQL).fetchall()
     return render_template("admin_directory.html", students=students)
 
+# Fetching all relevant fields based on your DESCRIBE output
+ATTENDANCE_CSV_SQL = text("""
+    SELECT a.attendance_id, u.name, a.student_id, a.timestamp, a.status 
+    FROM attendance a
+    JOIN users u ON a.student_id = u.user_id
+    ORDER BY a.timestamp DESC
+""")
+
 @app.route('/download_csv')
 def download_csv():
-    # Fetching all relevant fields based on your DESCRIBE output
-    query = text("""
-        SELECT a.attendance_id, u.name, a.student_id, a.timestamp, a.status 
-        FROM attendance a
-        JOIN users u ON a.student_id = u.user_id
-        ORDER BY a.timestamp DESC
-    """)
-    
     try:
-        records = db.session.execute(query).fetchall()
-
-        si = StringIO()
-        cw = csv.writer(si)
-        cw.writerow(['Log ID', 'Student Name', 'Student ID', 'Timestamp', 'Status'])
-        cw.writerows(records)
-
-        output = make_response(si.getvalue())
-        output.headers["Content-Disposition"] = "attachment; filename=attendance_report.csv"
-        output.headers["Content-type"] = "text/csv"
-        return output
+        # Server-side cursor: rows are pulled from MySQL as the response is written
+        conn = db.engine.connect().execution_options(stream_results=True)
+        try:
+            result = conn.execute(ATTENDANCE_CSV_SQL)
+        except Exception:
+            conn.close()
+            raise
     except Exception as e:
         return f"Download Error: {str(e)}", 500
 
+    def generate():
+        # A tiny reusable buffer keeps csv quoting without holding the whole report in memory
+        buf = StringIO()
+        cw = csv.writer(buf)
+
+        def line(row):
+            buf.seek(0)
+            buf.truncate(0)
+            cw.writerow(row)
+            return buf.getvalue()
+
+        try:
+            yield line(['Log ID', 'Student Name', 'Student ID', 'Timestamp', 'Status'])
+            for row in result:
+                yield line(row)
+        finally:
+            conn.close()
+
+    response = Response(generate(), mimetype="text/csv",
+                        headers={"Content-Disposition": "attachment; filename=attendance_report.csv"})
+    # A generator that never starts (HEAD, early disconnect) never runs its finally;
+    # the server always closes the response, so release the cursor there too (close is idempotent)
+    response.call_on_close(conn.close)
+    return response
+
 @app.route("/admin/view_student/<student_id>")
 def admin_view_student(student_id):
     """Allows admin to see the captured face images for a specific student."""
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
     
-    res = db.session.execute(text("SELECT name FROM users WHERE user_id = :sid"), {"sid": student_id}).fetchone()
+    res = db.session.execute(USER_NAME_SQL, {"sid": student_id}).fetchone()
     if not res:
         return redirect(url_for('admin_directory'))
     
     folder_path = os.path.join(DATASET_DIR, student_id)
-    images = [f for f in os.listdir(folder_path) if f.lower().endswith(('.jpg', '.png'))] if os.path.exists(folder_path) else []
-    return render_template("admin_view.html", student_id=student_id, student_name=res[0], images=sorted(images))
+    try:
+        # One stat per view; the folder is only rescanned when its contents change
+        images = list_dataset_images(folder_path, os.stat(folder_path).st_mtime_ns)
+    except FileNotFoundError:
+        images = []
+    return render_template("admin_view.html", student_id=student_id, student_name=res[0], images=images)
+
+DELETE_ATTENDANCE_SQL = text("DELETE FROM attendance WHERE student_id = :sid")
+DELETE_USER_SQL = text("DELETE FROM users WHERE user_id = :sid")
 
 @app.route("/admin/delete_student/<student_id>", methods=["POST"])
 def delete_student(student_id):
@@ -200,19 +376,15 @@ def delete_student(student_id):
         
     try:
         # 1. Delete associated attendance records first (Fixes the 500 error)
-        db.session.execute(
-            text("DELETE FROM attendance WHERE student_id = :sid"), 
-            {"sid": student_id}
-        )
+        db.session.execute(DELETE_ATTENDANCE_SQL, {"sid": student_id})
         
         # 2. Delete the student from the users table
-        db.session.execute(
-            text("DELETE FROM users WHERE user_id = :sid"), 
-            {"sid": student_id}
-        )
+        db.session.execute(DELETE_USER_SQL, {"sid": student_id})
         
         # Commit the database changes
         db.session.commit()
+        with _user_name_lock:
+            _user_name_cache.pop(student_id, None)
 
         # 3. Remove their image folder
         folder_path = os.path.join(DATASET_DIR, student_id)
@@ -231,11 +403,7 @@ def admin_train_trigger():
     if not session.get('admin_logged_in'):
         return jsonify({"error": "Unauthorized"}), 401
     
-    threading.Thread(
-        target=train_model_background, 
-        args=(DATASET_DIR, lambda p, m: write_train_status({"running":True, "progress":p, "message":m})), 
-        daemon=True
-    ).start()
+    threading.Thread(target=run_training_job, daemon=True).start()
     return jsonify({"status": "started"})
 
 @app.route("/dataset/<student_id>/<filename>")
@@ -243,7 +411,14 @@ def serve_dataset_image(student_id, filename):
     """Serves local image files so they can be displayed in the Admin 'View Student' page."""
     if not session.get('admin_logged_in'):
         return "Unauthorized", 401
-    return send_from_directory(os.path.join(DATASET_DIR, student_id), filename)
+    if DATASET_ACCEL_PREFIX:
+        # Validate the path here, then let Nginx stream the bytes
+        if safe_join(DATASET_DIR, student_id, filename) is None:
+            return "Not Found", 404
+        return Response(headers={"X-Accel-Redirect": f"{DATASET_ACCEL_PREFIX}/{quote(student_id)}/{quote(filename)}"})
+    # Enrollment images never change in place, so let browsers revalidate with ETag/304
+    return send_from_directory(os.path.join(DATASET_DIR, student_id), filename,
+                               conditional=True, max_age=DATASET_IMAGE_MAX_AGE)
 
 # --- ATTENDANCE SYSTEM ROUTES ---
 
@@ -253,28 +428,30 @@ def mark_attendance():
     return render_template("mark_attendance.html")
 
 
+# We use attendance_id as the first column to match your HTML's {{ r[0] }}
+_RECORD_SQL = """
+    SELECT a.attendance_id, a.student_id, u.name, a.timestamp 
+    FROM attendance a 
+    JOIN users u ON a.student_id = u.user_id 
+    {where} ORDER BY a.timestamp DESC
+"""
+# One prebuilt statement per period. Filters compare the bare column (>= a bound, never
+# DATE(a.timestamp) = ...) so MySQL can range-scan idx_attendance_timestamp
+ATTENDANCE_RECORD_SQL = {
+    period: text(_RECORD_SQL.format(where=where)) for period, where in {
+        "all": "",
+        "daily": "WHERE a.timestamp >= CURDATE()",
+        "weekly": "WHERE a.timestamp >= DATE_SUB(NOW(), INTERVAL 7 DAY)",
+        "monthly": "WHERE a.timestamp >= DATE_SUB(NOW(), INTERVAL 30 DAY)",
+    }.items()
+}
+
 @app.route('/attendance_record')
 def attendance_record():
     period = request.args.get('period', 'all')
     
-    # We use attendance_id as the first column to match your HTML's {{ r[0] }}
-    sql = """
-        SELECT a.attendance_id, a.student_id, u.name, a.timestamp 
-        FROM attendance a 
-        JOIN users u ON a.student_id = u.user_id 
-    """
-    
-    if period == 'daily':
-        sql += " WHERE DATE(a.timestamp) = CURDATE()"
-    elif period == 'weekly':
-        sql += " WHERE a.timestamp >= DATE_SUB(NOW(), INTERVAL 7 DAY)"
-    elif period == 'monthly':
-        sql += " WHERE a.timestamp >= DATE_SUB(NOW(), INTERVAL 30 DAY)"
-        
-    sql += " ORDER BY a.timestamp DESC"
-    
     try:
-        records = db.session.execute(text(sql)).fetchall()
+        records = db.session.execute(ATTENDANCE_RECORD_SQL.get(period, ATTENDANCE_RECORD_SQL["all"])).fetchall()
         return render_template('attendance_record.html', records=records)
     except Exception as e:
         return f"Database Error: {str(e)}", 500
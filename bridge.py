@@ -14,6 +14,7 @@ load_dotenv()
 GMAIL_USER = os.getenv("GMAIL_USER")
 GMAIL_APP_PASS = os.getenv("GMAIL_APP_PASS")
 RECIPIENT_EMAIL = os.getenv("RECIPIENT_EMAIL")
+URL_RE = re.compile(rb"https://[a-z0-9-]+\.trycloudflare\.com")
 
 def send_email(url):
 
@@ -37,29 +38,39 @@ def send_email(url):
 def start_bridge():
     print("🚀 Starting Cloudflare Tunnel...")
     # We use stderr=subprocess.STDOUT because cloudflared logs to stderr
+    # Binary pipe: we read raw chunks with os.read instead of waking up per line
     proc = subprocess.Popen(
         ['cloudflared', 'tunnel', 'run', '9be76f8f-dc1a-4c26-8d77-5b8ac8febbc3'], 
         stdout=subprocess.PIPE, 
-        stderr=subprocess.STDOUT, 
-        text=True
+        stderr=subprocess.STDOUT
     )
+    fd = proc.stdout.fileno()
+    pending = b""
 
-    url_found = False
-    
-    # Read output line by line
     try:
-        for line in iter(proc.stdout.readline, ''):
+        # Phase 1: scan complete log lines until the tunnel URL shows up
+        while True:
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                return
             # Print logs to console so we can see what's happening
-            sys.stdout.write(line) 
-            
-            if not url_found:
-                match = re.search(r"https://[a-z0-9-]+\.trycloudflare\.com", line)
-                if match:
-                    url = match.group(0)
-                    print(f"\n✨ FOUND URL: {url}")
-                    send_email(url)
-                    url_found = True
-                    print("🔗 Bridge active. Leave this terminal open.\n")
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+
+            *lines, pending = (pending + chunk).split(b"\n")
+            match = next(filter(None, map(URL_RE.search, lines)), None)
+            if match:
+                url = match.group(0).decode()
+                print(f"\n✨ FOUND URL: {url}")
+                send_email(url)
+                print("🔗 Bridge active. Leave this terminal open.\n")
+                break
+
+        # Phase 2: keep draining so cloudflared never blocks on a full pipe; no more matching
+        while chunk:
+            chunk = os.read(fd, 4096)
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
     except KeyboardInterrupt:
         print("\nStopping Bridge...")
         proc.terminate()
@@ -0,0 +1,39 @@
+#!/usr/bin/env bash
+# Builds OpenCV + contrib for the Pi 5 (Cortex-A76, 64-bit OS) into the active venv.
+# Optional: the pip wheel already has baseline NEON; this adds the A76's FP16/dot-product
+# kernels and -O3 -mcpu tuning for cvtColor/resize/LUT. Run inside the venv:
+#   source venv/bin/activate && ./build_opencv.sh
+# On aarch64 NEON is mandatory, so the 32-bit -mfpu/-mfloat-abi/VFPV3 flags don't apply.
+set -euo pipefail
+
+OPENCV_VERSION="${OPENCV_VERSION:-4.10.0}"
+PYTHON="${PYTHON:-$(command -v python)}"
+BUILD_DIR="${BUILD_DIR:-$HOME/opencv-build}"
+JOBS="${JOBS:-$(nproc)}"
+
+sudo apt install -y cmake ninja-build pkg-config libjpeg-dev libpng-dev libtiff-dev
+
+mkdir -p "$BUILD_DIR" && cd "$BUILD_DIR"
+[ -d opencv ] || git clone --depth 1 -b "$OPENCV_VERSION" https://github.com/opencv/opencv.git
+[ -d opencv_contrib ] || git clone --depth 1 -b "$OPENCV_VERSION" https://github.com/opencv/opencv_contrib.git
+
+cmake -S opencv -B build -G Ninja \
+    -DCMAKE_BUILD_TYPE=Release \
+    -DCMAKE_CXX_FLAGS="-O3 -mcpu=cortex-a76" \
+    -DCMAKE_C_FLAGS="-O3 -mcpu=cortex-a76" \
+    -DCPU_BASELINE=NEON \
+    -DCPU_DISPATCH="NEON_FP16;NEON_DOTPROD" \
+    -DENABLE_NEON=ON \
+    -DOPENCV_EXTRA_MODULES_PATH="$BUILD_DIR/opencv_contrib/modules" \
+    -DBUILD_LIST="core,imgproc,imgcodecs,tracking,python3" \
+    -DWITH_GTK=OFF -DWITH_QT=OFF -DWITH_OPENCL=OFF \
+    -DBUILD_TESTS=OFF -DBUILD_PERF_TESTS=OFF -DBUILD_EXAMPLES=OFF -DBUILD_DOCS=OFF \
+    -DPYTHON3_EXECUTABLE="$PYTHON" \
+    -DOPENCV_PYTHON3_INSTALL_PATH="$("$PYTHON" -c 'import sysconfig; print(sysconfig.get_paths()["platlib"])')"
+cmake --build build -j "$JOBS"
+
+# The wheel would shadow the source build; remove it first
+"$PYTHON" -m pip uninstall -y opencv-contrib-python-headless opencv-python opencv-python-headless || true
+cmake --install build
+
+"$PYTHON" -c 'import cv2; print(cv2.__version__); print(cv2.getBuildInformation().split("CPU/HW features:")[1][:300])'
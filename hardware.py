@@ -3,24 +3,25 @@
 Pi-Safe Hardware Abstraction Layer with Self-Healing I2C Logic
 """
 
-import os
 import time
-import platform
+import queue
+import threading
+from functools import lru_cache
 
 # =========================================================
 # ENVIRONMENT DETECTION
 # =========================================================
 
+@lru_cache(maxsize=1)
 def is_raspberry_pi() -> bool:
+    """
+    Reads /proc/device-tree/model once per process (cached)
+    """
     try:
-        if platform.system() != "Linux":
-            return False
-        model_path = "/proc/device-tree/model"
-        if os.path.exists(model_path):
-            with open(model_path, "r") as f:
-                return "raspberry pi" in f.read().lower()
-        return False
-    except Exception:
+        with open("/proc/device-tree/model", "rb") as f:
+            return b"raspberry pi" in f.read(64).lower()
+    except OSError:
+        # Missing on non-Pi Linux, and on macOS/Windows
         return False
 
 IS_PI = is_raspberry_pi()
@@ -75,31 +76,54 @@ if IS_PI:
 # SMART OUTPUT FUNCTIONS (SELF-HEALING)
 # =========================================================
 
+LCD_COLS = 16
+BLANK_ROW = " " * LCD_COLS
+# What is currently on the glass, per row; "" means unknown (forces a full row write)
+_lcd_last = ["", ""]
+
+def _lcd_write_row(row: int, text: str):
+    """
+    Rewrites only the span of cells that differ from what is already shown
+    """
+    prev = _lcd_last[row]
+    if len(prev) != LCD_COLS:
+        start, end = 0, LCD_COLS
+    else:
+        diff = [i for i in range(LCD_COLS) if prev[i] != text[i]]
+        if not diff:
+            return
+        start, end = diff[0], diff[-1] + 1
+    lcd.cursor_pos = (row, start)
+    lcd.write_string(text[start:end])
+    _lcd_last[row] = text
+
 def lcd_display(line1: str = "", line2: str = ""):
     """
     Display text with automatic I2C recovery if garbage/errors occur
     """
-    global lcd
-    l1 = (line1 or "")[:16]
-    l2 = (line2 or "")[:16]
+    global lcd, _lcd_last
+    l1 = (line1 or "")[:LCD_COLS]
+    l2 = (line2 or "")[:LCD_COLS]
 
     if IS_PI:
         try:
             if not lcd:
                 lcd = init_lcd()
+                _lcd_last = [BLANK_ROW, BLANK_ROW]  # init_lcd() clears the screen
             
             if lcd:
-                lcd.clear()
-                lcd.write_string(l1)
-                lcd.cursor_pos = (1, 0)
-                lcd.write_string(l2)
+                # Padding overwrites leftovers, so no clear() (and its refresh delay) is needed
+                _lcd_write_row(0, l1.ljust(LCD_COLS))
+                _lcd_write_row(1, l2.ljust(LCD_COLS))
         except Exception as e:
             print(f"[LCD I2C ERROR] {e}. Attempting hardware reset...")
             time.sleep(0.1) # Brief pause for bus stabilization
             lcd = init_lcd() # Recovery attempt
+            _lcd_last = ["", ""]
             if lcd:
                 try:
                     lcd.write_string(l1)
+                    _lcd_last = [l1.ljust(LCD_COLS), BLANK_ROW]
                 except:
                     pass
     else:
@@ -109,7 +133,7 @@ def lcd_display(line1: str = "", line2: str = ""):
         print(output)
 
 
-def buzzer_beep(times: int = 1, duration: float = 0.2):
+def _buzzer_pulse(times: int, duration: float):
     if IS_PI and GPIO:
         try:
             for _ in range(times):
@@ -122,6 +146,24 @@ def buzzer_beep(times: int = 1, duration: float = 0.2):
     else:
         print("[BUZZER]", "Beep " * times)
 
+# Beeps get their own thread so LCD updates (and callers) never wait out the sleeps
+_buzzer_q = queue.Queue(maxsize=8)
+
+def _buzzer_worker():
+    while True:
+        _buzzer_pulse(*_buzzer_q.get())
+
+threading.Thread(target=_buzzer_worker, daemon=True).start()
+
+def buzzer_beep(times: int = 1, duration: float = 0.2):
+    """
+    Queues a beep pattern and returns immediately (dropped if beeps are already backed up)
+    """
+    try:
+        _buzzer_q.put_nowait((times, duration))
+    except queue.Full:
+        pass
+
 # =========================================================
 # HIGH-LEVEL PUBLIC API
 # =========================================================
@@ -145,6 +187,38 @@ def attendance_unknown():
 def system_message(line1: str, line2: str = ""):
     lcd_display(line1, line2)
 
+# =========================================================
+# ASYNC FEEDBACK (keeps I2C/GPIO off the recognition path)
+# =========================================================
+
+_FEEDBACK_EVENTS = {
+    "success": attendance_success,
+    "duplicate": attendance_duplicate,
+    "unknown": attendance_unknown,
+    "message": system_message,
+}
+_feedback_q = queue.Queue(maxsize=32)
+
+def _feedback_worker():
+    while True:
+        event, args = _feedback_q.get()
+        try:
+            _FEEDBACK_EVENTS[event](*args)
+        except Exception as e:
+            print(f"[FEEDBACK ERROR] {event}: {e}")
+
+threading.Thread(target=_feedback_worker, daemon=True).start()
+
+def notify(event: str, *args):
+    """
+    Fire-and-forget LCD/buzzer feedback, e.g. notify("success", name, conf).
+    Events are played in order by one worker; they are dropped if the queue is full.
+    """
+    try:
+        _feedback_q.put_nowait((event, args))
+    except queue.Full:
+        pass
+
 # =========================================================
 # CLEANUP
 # =========================================================
@@ -5,7 +5,7 @@ import sys
 import datetime
 import mlflow
 import mlflow.sklearn
-from model import train_model_background
+from model import train_model_background, MODEL_PATH
 
 # 1. MLflow Configuration (Matched to your PuTTY port 5050)
 mlflow.set_tracking_uri("http://localhost:5050") 
@@ -22,14 +22,18 @@ def run_manual_fix():
         print(f"❌ Error: The folder '{dataset_dir}' does not exist.")
         return
 
-    student_folders = [f for f in os.listdir(dataset_dir) if os.path.isdir(os.path.join(dataset_dir, f))]
+    with os.scandir(dataset_dir) as it:
+        student_folders = [e.path for e in it if e.is_dir()]
     
     if len(student_folders) == 0:
         print("❌ Error: No student folders found.")
         return
 
     # Metadata for MLflow
-    total_images = sum([len(os.listdir(os.path.join(dataset_dir, f))) for f in student_folders])
+    total_images = 0
+    for folder in student_folders:
+        with os.scandir(folder) as it:
+            total_images += sum(1 for e in it if e.is_file())
 
     print(f"✅ Found {len(student_folders)} student(s) | {total_images} total images.")
     print("🚀 Starting AI Model Retraining with MLflow Tracking...")
@@ -50,8 +54,8 @@ def run_manual_fix():
             
             # 4. Log the "Result" (Artifacts)
             # This saves a copy of the model inside MLflow so you can't lose it
-            if os.path.exists("model.pkl"):
-                mlflow.log_artifact("model.pkl")
+            if os.path.exists(MODEL_PATH):
+                mlflow.log_artifact(MODEL_PATH)
             if os.path.exists("le.pickle"):
                 mlflow.log_artifact("le.pickle")
             
@@ -4,15 +4,32 @@ import cv2
 import numpy as np
 import pickle
 import json
+import hashlib
+import threading
+from functools import lru_cache
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import mlflow
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.decomposition import PCA
 from sklearn.metrics import accuracy_score
 
 # --- FILE PATHS & CONSTANTS ---
 # Using absolute paths where possible to ensure background threads find the files
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 TRAIN_STATUS_FILE = os.path.join(APP_DIR, "train_status.json")
-MODEL_PATH = os.path.join(APP_DIR, "model.pkl")
+MODEL_PATH = os.path.join(APP_DIR, "model.npz")
+# Pickled sklearn/CentroidModel from older releases; still loaded until the first retrain
+LEGACY_MODEL_PATH = os.path.join(APP_DIR, "model.pkl")
+EMBED_CACHE_PATH = os.path.join(APP_DIR, "embeddings_cache.npz")
+# Bump whenever crop_face_and_embed changes so stale vectors are discarded
+EMBED_CACHE_VERSION = 2
+EMBED_DIM = 32 * 32
+# Raw 1024-pixel vectors are projected down (and mean-centered) before matching
+PCA_COMPONENTS = 64
+
+# In-process classifier cache, refreshed only when the model file changes on disk
+_clf_cache = {"mtime": None, "clf": None}
+_clf_lock = threading.Lock()
 
 # -------------------------------
 # Helper: Status Sync
@@ -28,10 +45,232 @@ def write_final_status(data):
 # -------------------------------
 # Utility: Image Processing
 # -------------------------------
-def crop_face_and_embed(bgr_image, detection):
+# Detector input cap; larger images are shrunk before MediaPipe sees them. BlazeFace
+# resamples to 128x128 (short range) or 192x192 (full range) internally, so more
+# pixels than this only add a copy + resize inside the graph
+DETECT_MAX_W, DETECT_MAX_H = 320, 240
+
+def downscale_for_detection(bgr_image):
     """
-    Crops the face from a BGR image using MediaPipe detections 
-    and converts it to a 32x32 grayscale normalized vector.
+    Returns the image shrunk to fit DETECT_MAX_W x DETECT_MAX_H (never upscaled).
+    MediaPipe boxes are relative, so they still map onto the full-resolution original.
+    """
+    h, w = bgr_image.shape[:2]
+    scale = min(DETECT_MAX_W / w, DETECT_MAX_H / h, 1.0)
+    if scale >= 1.0:
+        return bgr_image
+    return cv2.resize(bgr_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+# --- Direct BlazeFace (short-range) through the TFLite runtime, skipping the MediaPipe graph ---
+try:
+    from tflite_runtime.interpreter import Interpreter as TFLiteInterpreter
+except ImportError:
+    TFLiteInterpreter = None
+
+BLAZEFACE_SIZE = 128
+BLAZEFACE_NMS_IOU = 0.3
+
+def blazeface_model_path():
+    """BLAZEFACE_MODEL from the environment, else the copy bundled with the mediapipe package (or None)."""
+    path = os.getenv("BLAZEFACE_MODEL")
+    if not path:
+        import importlib.util
+        spec = importlib.util.find_spec("mediapipe")
+        if spec is None or not spec.submodule_search_locations:
+            return None
+        path = os.path.join(list(spec.submodule_search_locations)[0],
+                            "modules", "face_detection", "face_detection_short_range.tflite")
+    return path if os.path.exists(path) else None
+
+def blazeface_anchors():
+    """(896, 2) anchor centres for the 128x128 short-range model: 16x16 grid x 2, then 8x8 grid x 6."""
+    anchors = []
+    for grid, per_cell in ((16, 2), (8, 6)):
+        centres = (np.arange(grid, dtype=np.float32) + 0.5) / grid
+        cy, cx = np.meshgrid(centres, centres, indexing="ij")
+        cell = np.stack([cx.ravel(), cy.ravel()], axis=1)
+        anchors.append(np.repeat(cell, per_cell, axis=0))
+    return np.concatenate(anchors)
+
+def nms(boxes, scores, iou_thresh):
+    """Greedy non-maximum suppression on (n, 4) x1,y1,x2,y2 boxes; returns kept indices, best first."""
+    order = scores.argsort()[::-1]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        h = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        inter = w * h
+        order = rest[inter / (areas[i] + areas[rest] - inter + 1e-9) <= iou_thresh]
+    return keep
+
+def box_detection(xmin, ymin, width, height, score=1.0):
+    """A detection shaped like MediaPipe's (score, location_data.relative_bounding_box)."""
+    bbox = SimpleNamespace(xmin=float(xmin), ymin=float(ymin), width=float(width), height=float(height))
+    return SimpleNamespace(score=[float(score)], location_data=SimpleNamespace(relative_bounding_box=bbox))
+
+class BlazeFaceDetector:
+    """
+    BlazeFace run straight through a TFLite interpreter (XNNPACK on arm64).
+    Scores are thresholded in logit space before anything is decoded, so only likely faces
+    pay for box decoding and NMS. Detections mimic MediaPipe's (location_data.relative_bounding_box),
+    so crop_face() and the camera loop take either.
+    """
+    def __init__(self, model_path, min_conf, num_threads=2):
+        self.interp = TFLiteInterpreter(model_path=model_path, num_threads=num_threads)
+        self.interp.allocate_tensors()
+        self.input_index = self.interp.get_input_details()[0]["index"]
+        outputs = self.interp.get_output_details()
+        # (1, 896, 16) regressors and (1, 896, 1) scores; told apart by shape, not output order
+        self.box_index = next(o["index"] for o in outputs if o["shape"][-1] == 16)
+        self.score_index = next(o["index"] for o in outputs if o["shape"][-1] == 1)
+        self.anchors = blazeface_anchors()
+        self.min_logit = np.log(min_conf / (1.0 - min_conf))
+        self.square = np.zeros((BLAZEFACE_SIZE, BLAZEFACE_SIZE, 3), np.uint8)
+        self.tensor = np.empty((1, BLAZEFACE_SIZE, BLAZEFACE_SIZE, 3), np.float32)
+
+    def process(self, rgb_image):
+        """Returns a list of detections (None if no face) for an RGB or grayscale image of any size."""
+        h, w = rgb_image.shape[:2]
+        # Letterbox into the square input (as MediaPipe does) so faces keep their aspect ratio
+        scale = BLAZEFACE_SIZE / max(h, w)
+        nw, nh = round(w * scale), round(h * scale)
+        ox, oy = (BLAZEFACE_SIZE - nw) // 2, (BLAZEFACE_SIZE - nh) // 2
+        self.square.fill(0)
+        if (nh, nw) != (h, w): # Else the caller already sized it (camera loop)
+            rgb_image = cv2.resize(rgb_image, (nw, nh), interpolation=cv2.INTER_AREA)
+        # Gray broadcasts into all three channels during the copy (no GRAY2RGB image first)
+        self.square[oy:oy + nh, ox:ox + nw] = rgb_image if rgb_image.ndim == 3 else rgb_image[..., np.newaxis]
+        np.multiply(self.square, np.float32(2.0 / 255.0), out=self.tensor[0], dtype=np.float32) # [-1, 1] after the shift
+        self.tensor -= 1.0
+
+        self.interp.set_tensor(self.input_index, self.tensor)
+        self.interp.invoke()
+        logits = self.interp.get_tensor(self.score_index)[0, :, 0]
+        hits = np.flatnonzero(logits > self.min_logit)
+        if not hits.size:
+            return None
+
+        # Decode only the surviving anchors: centre offsets and sizes are in input pixels
+        raw = self.interp.get_tensor(self.box_index)[0, hits, :4] / BLAZEFACE_SIZE
+        cx = raw[:, 0] + self.anchors[hits, 0]
+        cy = raw[:, 1] + self.anchors[hits, 1]
+        boxes = np.stack([cx - raw[:, 2] / 2, cy - raw[:, 3] / 2, cx + raw[:, 2] / 2, cy + raw[:, 3] / 2], axis=1)
+        scores = 1.0 / (1.0 + np.exp(-logits[hits]))
+
+        detections = []
+        for i in nms(boxes, scores, BLAZEFACE_NMS_IOU):
+            # Undo the letterbox: square-relative -> image-relative coordinates
+            x1 = (boxes[i, 0] * BLAZEFACE_SIZE - ox) / nw
+            y1 = (boxes[i, 1] * BLAZEFACE_SIZE - oy) / nh
+            x2 = (boxes[i, 2] * BLAZEFACE_SIZE - ox) / nw
+            y2 = (boxes[i, 3] * BLAZEFACE_SIZE - oy) / nh
+            detections.append(box_detection(x1, y1, x2 - x1, y2 - y1, scores[i]))
+        return detections
+
+# --- YuNet (libfacedetection's CNN, built into OpenCV >= 4.7 as cv2.FaceDetectorYN) ---
+# Opt in with FACE_DETECTOR=yunet; the ONNX file is not bundled with anything, so
+# YUNET_MODEL points at it (default: next to this file)
+FACE_DETECTOR = os.getenv("FACE_DETECTOR", "blazeface").lower()
+YUNET_MODEL = os.getenv("YUNET_MODEL", os.path.join(APP_DIR, "face_detection_yunet_2023mar.onnx"))
+YUNET_NMS_IOU = 0.3
+YUNET_TOP_K = 50
+
+class YuNetDetector:
+    """
+    YuNet through OpenCV's DNN module (NEON kernels on arm64). Covers near and far faces in
+    one model, so it stands in for both MediaPipe ranges. Boxes come back in input pixels and
+    are converted to the same relative, best-first detections as BlazeFaceDetector.
+    """
+    def __init__(self, model_path, min_conf):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(model_path)
+        self.net = cv2.FaceDetectorYN.create(model_path, "", (DETECT_MAX_W, DETECT_MAX_H),
+                                             min_conf, YUNET_NMS_IOU, YUNET_TOP_K)
+        self.size = (DETECT_MAX_W, DETECT_MAX_H)
+
+    def process(self, rgb_image):
+        """Returns a list of detections (None if no face) for an RGB or grayscale image of any size."""
+        h, w = rgb_image.shape[:2]
+        if (w, h) != self.size: # The camera loop always sends the same size, so this is a one-off
+            self.net.setInputSize((w, h))
+            self.size = (w, h)
+        # YuNet was trained on 3-channel BGR
+        code = cv2.COLOR_GRAY2BGR if rgb_image.ndim == 2 else cv2.COLOR_RGB2BGR
+        _, faces = self.net.detect(cv2.cvtColor(rgb_image, code))
+        if faces is None:
+            return None
+        # Rows are x, y, w, h, five landmarks, score
+        faces = faces[np.argsort(-faces[:, 14])]
+        return [box_detection(f[0] / w, f[1] / h, f[2] / w, f[3] / h, f[14]) for f in faces]
+
+def _direct_detector(min_conf, num_threads=2, blazeface=True):
+    """
+    YuNet when FACE_DETECTOR=yunet, else (if blazeface) short-range BlazeFace straight through
+    tflite_runtime; None when neither can be built, leaving the caller to use the MediaPipe graph.
+    """
+    if FACE_DETECTOR == "yunet":
+        try:
+            return YuNetDetector(YUNET_MODEL, min_conf)
+        except Exception as e:
+            print(f"[MODEL] YuNet unavailable ({e}) - falling back")
+    path = blazeface_model_path() if blazeface and TFLiteInterpreter is not None else None
+    if path:
+        try:
+            return BlazeFaceDetector(path, min_conf, num_threads=num_threads)
+        except Exception as e:
+            print(f"[MODEL] Direct BlazeFace unavailable ({e}) - using MediaPipe")
+    return None
+
+def training_detector_id():
+    """
+    Names the detector training crops faces with (FACE_DETECTOR plus its model file).
+    Boxes, and so every cached embedding, depend on it; the embedding cache is dropped when it changes.
+    """
+    if FACE_DETECTOR == "yunet" and os.path.exists(YUNET_MODEL):
+        return f"yunet:{os.path.abspath(YUNET_MODEL)}"
+    path = blazeface_model_path() if TFLiteInterpreter is not None else None
+    return f"blazeface:{os.path.abspath(path)}" if path else "mediapipe"
+
+@lru_cache(maxsize=4)
+def _get_mp_face(model_selection, min_conf):
+    """
+    Builds a face detector once per config (loading the model is the slow part)
+    and pairs it with a lock, since a detector instance must not be used by two threads at once.
+    YuNet (if selected) serves every config; direct BlazeFace only short-range (model_selection=0).
+    """
+    if model_selection == 0 or FACE_DETECTOR == "yunet":
+        detector = _direct_detector(min_conf, blazeface=model_selection == 0)
+        if detector is not None:
+            return detector, threading.Lock()
+
+    import mediapipe as mp
+    detector = mp.solutions.face_detection.FaceDetection(
+        model_selection=model_selection, min_detection_confidence=min_conf
+    )
+    return detector, threading.Lock()
+
+def detect_faces(rgb_image, model_selection=0, min_conf=0.5):
+    """
+    Runs the shared detector for this config on an RGB or grayscale image
+    and returns its detections (None if no face).
+    """
+    detector, lock = _get_mp_face(model_selection, min_conf)
+    if isinstance(detector, (BlazeFaceDetector, YuNetDetector)):
+        with lock:
+            return detector.process(rgb_image)
+    if rgb_image.ndim == 2:
+        rgb_image = cv2.cvtColor(rgb_image, cv2.COLOR_GRAY2RGB) # The MediaPipe graph wants 3 channels
+    with lock:
+        return detector.process(rgb_image).detections
+
+def crop_face(bgr_image, detection):
+    """
+    Crops the face from a BGR (or already grayscale) image using MediaPipe detections
+    and returns it as a 32x32 grayscale uint8 patch (or None).
     """
     h, w = bgr_image.shape[:2]
 
@@ -47,95 +286,380 @@ def crop_face_and_embed(bgr_image, detection):
 
     # Crop, grayscale, and resize
     face = bgr_image[y1:y2, x1:x2]
-    face = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
-    face = cv2.resize(face, (32, 32), interpolation=cv2.INTER_AREA)
+    if face.ndim == 3:
+        face = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(face, (32, 32), interpolation=cv2.INTER_AREA)
+
+# uint8 -> [0, 1] float32 in one fused multiply (no astype copy, no float64 temporaries)
+_PIXEL_SCALE = np.float32(1.0 / 255.0)
+
+def normalize_faces(patches, out=None):
+    """
+    Flattens and normalizes a stack of 32x32 uint8 patches to float32 rows (0.0 to 1.0) in one pass.
+    out, if given, is a (len(patches), 1024) float32 array to fill instead of allocating one.
+    """
+    return np.multiply(np.stack(patches).reshape(len(patches), EMBED_DIM), _PIXEL_SCALE, out=out, dtype=np.float32)
+
+def crop_face_and_embed(bgr_image, detection):
+    """
+    Crops the face from a BGR (or grayscale) image using MediaPipe detections
+    and converts it to a 32x32 grayscale normalized vector.
+    """
+    face = crop_face(bgr_image, detection)
+    if face is None:
+        return None
 
-    # Flatten and normalize (0.0 to 1.0)
-    return face.flatten().astype(np.float32) / 255.0
+    # Flatten (view, no copy) and normalize (0.0 to 1.0)
+    return np.multiply(face.reshape(-1), _PIXEL_SCALE, dtype=np.float32)
 
 def extract_embedding_for_image(stream_or_bytes):
     """
-    Takes a Flask file stream, detects the face, and returns the embedding.
+    Takes a Flask file stream (or raw bytes), detects the face, and returns the embedding.
     Used during enrollment and single-image testing.
     """
-    import mediapipe as mp
-    mp_face = mp.solutions.face_detection.FaceDetection(
-        model_selection=1, min_detection_confidence=0.5
-    )
+    data = stream_or_bytes if isinstance(stream_or_bytes, (bytes, bytearray, memoryview)) else stream_or_bytes.read()
+    return extract_embedding_for_bytes(data)
 
-    # Decode image from stream
-    data = stream_or_bytes.read()
-    arr = np.frombuffer(data, np.uint8)
-    img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-    
+def extract_embedding_for_bytes(buf):
+    """Decodes raw JPEG/PNG bytes straight into a BGR array with cv2.imdecode and returns the embedding (or None)."""
+    # Decode image bytes (zero-copy view) directly to BGR uint8
+    img = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
     if img is None:
         return None
 
-    # Process face detection
-    results = mp_face.process(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-    if not results.detections:
+    # Process face detection on a capped-size copy with the shared detector; crop from the original
+    detections = detect_faces(cv2.cvtColor(downscale_for_detection(img), cv2.COLOR_BGR2RGB),
+                              model_selection=1, min_conf=0.5)
+    if not detections:
         return None
+    return crop_face_and_embed(img, detections[0])
+
+# -------------------------------
+# Embedding Cache (keyed by image content hash)
+# -------------------------------
+def image_stat_key(entry):
+    """Path, size and mtime of a dataset image (os.DirEntry); unchanged files keep the same key."""
+    st = entry.stat()
+    return f"{entry.path}|{st.st_size}|{st.st_mtime_ns}"
+
+def load_embedding_cache():
+    """
+    Returns ({content_hash: embedding or None}, {stat_key: content_hash}) from disk.
+    None marks an image where no face was found. The stat index lets unchanged files skip
+    being read and hashed at all. Missing or stale caches (another version or detector) give ({}, {}).
+    """
+    try:
+        with np.load(EMBED_CACHE_PATH) as data:
+            if int(data["version"]) != EMBED_CACHE_VERSION or str(data["detector"]) != training_detector_id():
+                return {}, {}
+            cache = {
+                str(h): (emb if found else None)
+                for h, emb, found in zip(data["hashes"], data["embeddings"], data["found"])
+            }
+            return cache, dict(zip(data["stat_keys"].tolist(), data["stat_hashes"].tolist()))
+    except (OSError, KeyError, ValueError):
+        return {}, {}
+
+def save_embedding_cache(cache, index):
+    """Writes the embedding cache and its stat index atomically as a compressed .npz file."""
+    hashes = list(cache)
+    found = np.array([cache[h] is not None for h in hashes], dtype=bool)
+    embeddings = np.zeros((len(hashes), EMBED_DIM), dtype=np.float32)
+    for i, h in enumerate(hashes):
+        if cache[h] is not None:
+            embeddings[i] = cache[h]
+
+    tmp_path = EMBED_CACHE_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, version=EMBED_CACHE_VERSION, detector=training_detector_id(),
+                            hashes=np.array(hashes, dtype="U32"),
+                            embeddings=embeddings, found=found,
+                            stat_keys=np.array(list(index), dtype=str),
+                            stat_hashes=np.array(list(index.values()), dtype="U32"))
+    os.replace(tmp_path, EMBED_CACHE_PATH)
+
+# -------------------------------
+# Nearest-Centroid Matcher
+# -------------------------------
+def l2_normalize(X):
+    """Scales each row to unit length (rows of zeros are left as zeros)."""
+    norms = np.linalg.norm(X, axis=-1, keepdims=True)
+    return X / np.maximum(norms, 1e-12)
+
+def quantize_int8(X):
+    """Symmetric per-row int8 quantization. Returns (int8 rows, float32 scale per row)."""
+    scale = np.maximum(np.abs(X).max(axis=-1), 1e-12) / 127.0
+    q = np.round(X / scale[..., np.newaxis]).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+class CentroidModel:
+    """
+    One unit-length template per student in PCA space, stored as int8.
+    Scoring is a single integer matrix product (cosine similarity), so inference needs NumPy only.
+    A model with no PCA components (a single enrolled student) matches raw, uncentred embeddings.
+    """
+    def __init__(self, classes, centroids, mean, components):
+        self.classes_ = classes          # (k,) user_ids
+        self.mean = mean                # (1024,) float32, PCA mean
+        self.components = components    # (d, 1024) float32, PCA basis
+        # (k, d) int8 templates + (k,) dequantization scales: 4x less to stream than float32
+        self.centroids_q, self.centroid_scale = quantize_int8(centroids)
+
+    def projection(self):
+        """(1024, d) basis and (d,) projected mean, built once per model: (X - mean) @ C.T == X @ C.T - mean @ C.T."""
+        p = getattr(self, "_projection", None) # Absent on loaded/unpickled models until first use
+        if p is None:
+            basis_t = np.ascontiguousarray(self.components.T)
+            p = self._projection = (basis_t, self.mean @ basis_t)
+        return p
+
+    def project(self, X):
+        """Maps (n, 1024) embeddings to unit-length (n, d) PCA vectors (n, 1024 without PCA)."""
+        if not self.components.shape[0]:
+            return l2_normalize(X)
+        # Folding the mean into the projection skips an elementwise pass and an (n, 1024) temporary
+        basis_t, mean_proj = self.projection()
+        return l2_normalize(X @ basis_t - mean_proj)
+
+    def templates_t(self):
+        """(d, k) float32 copy of the int8 templates for the scoring product, built once per model."""
+        t = getattr(self, "_templates_t", None) # Absent on loaded/unpickled models until first use
+        if t is None:
+            t = self._templates_t = np.ascontiguousarray(self.centroids_q.T, dtype=np.float32)
+        return t
+
+    def scores(self, X):
+        """Returns (n, k) cosine similarities of each embedding to every student."""
+        zq, z_scale = quantize_int8(self.project(X))
+        # The int8 dot products are exact in float32 (|sum| <= 127*127*d < 2**24 for d <= 1040),
+        # so the product runs through BLAS sgemm rather than NumPy's unvectorized integer matmul
+        dots = zq.astype(np.float32) @ self.templates_t()
+        return dots * z_scale[:, np.newaxis] * self.centroid_scale
+
+    def predict(self, X):
+        return self.classes_[self.scores(X).argmax(axis=1)]
+
+    def save(self, path):
+        """Writes the raw arrays as an uncompressed .npz (no pickle, nothing to rebuild on load)."""
+        with open(path, "wb") as f:
+            np.savez(f, classes=self.classes_, mean=self.mean, components=self.components,
+                     centroids_q=self.centroids_q, centroid_scale=self.centroid_scale)
 
-    return crop_face_and_embed(img, results.detections[0])
+    @classmethod
+    def load(cls, path):
+        """Reads a model written by save(); the stored int8 templates are used as-is."""
+        model = cls.__new__(cls)
+        with np.load(path, allow_pickle=False) as data:
+            model.classes_ = data["classes"]
+            model.mean = data["mean"]
+            model.components = data["components"]
+            model.centroids_q = data["centroids_q"]
+            model.centroid_scale = data["centroid_scale"]
+        return model
+
+def fit_centroid_model(X, y, n_components):
+    """Fits PCA on the training embeddings and averages each student's projected vectors."""
+    classes = np.unique(y)
+    if len(classes) < 2:
+        # Centering on the only student's own mean would leave nothing but noise to match,
+        # so one student gets the plain normalized-embedding template (no PCA) instead
+        centroid = l2_normalize(l2_normalize(X).mean(axis=0, keepdims=True))
+        return CentroidModel(
+            classes,
+            centroid.astype(np.float32),
+            np.zeros(X.shape[1], dtype=np.float32),
+            np.zeros((0, X.shape[1]), dtype=np.float32)
+        )
+
+    pca = PCA(n_components=n_components, random_state=42).fit(X)
+    Z = l2_normalize(pca.transform(X))
+    centroids = l2_normalize(np.stack([Z[y == c].mean(axis=0) for c in classes]))
+    return CentroidModel(
+        classes,
+        centroids.astype(np.float32),
+        pca.mean_.astype(np.float32),
+        pca.components_.astype(np.float32)
+    )
 
 # -------------------------------
 # Model Loading & Prediction
 # -------------------------------
 def load_model_if_exists():
-    """Returns the loaded pickle model or None if not trained yet."""
-    if not os.path.exists(MODEL_PATH):
+    """
+    Returns the trained classifier or None if not trained yet.
+    The loaded model is cached and only reloaded when the model file's mtime changes.
+    """
+    for path in (MODEL_PATH, LEGACY_MODEL_PATH):
+        try:
+            mtime = (path, os.stat(path).st_mtime)
+            break
+        except FileNotFoundError:
+            continue
+    else:
         return None
-    with open(MODEL_PATH, "rb") as f:
-        return pickle.load(f)
+
+    if _clf_cache["mtime"] == mtime:
+        return _clf_cache["clf"]
+
+    with _clf_lock:
+        # Another thread may have reloaded while we waited for the lock
+        if _clf_cache["mtime"] != mtime:
+            if path == MODEL_PATH:
+                _clf_cache["clf"] = CentroidModel.load(path)
+            else:
+                with open(path, "rb") as f:
+                    _clf_cache["clf"] = pickle.load(f)
+            _clf_cache["mtime"] = mtime
+        return _clf_cache["clf"]
+
+def predict_batch_with_model(clf, embs):
+    """
+    Scores an (n, 1024) stack of embeddings against every student in one matrix product.
+    Returns [(user_id, confidence), ...] in the same order as the rows.
+    """
+    if not isinstance(clf, CentroidModel):
+        # Legacy model.pkl trained before the centroid matcher (sklearn classifier); retrain to upgrade
+        scores = clf.predict_proba(embs)
+    else:
+        scores = clf.scores(embs)
+    best = scores.argmax(axis=1)
+    return [(clf.classes_[i], float(scores[row, i])) for row, i in enumerate(best)]
 
 def predict_with_model(clf, emb):
-    """Predicts user_id and confidence score from an embedding."""
-    proba = clf.predict_proba([emb])[0]
-    idx = np.argmax(proba)
-    return clf.classes_[idx], float(proba[idx])
+    """Predicts user_id and confidence (cosine similarity to the best centroid) from an embedding."""
+    return predict_batch_with_model(clf, emb[np.newaxis])[0]
 
 # -------------------------------
 # Main Training Logic
 # -------------------------------
+# TFLite/MediaPipe and OpenCV release the GIL, so threads give real parallelism here
+# (and, unlike a process pool, are safe to start from inside the Flask/camera process)
+TRAIN_WORKERS = min(4, os.cpu_count() or 1)
+_train_local = threading.local()
+
+def _training_detector():
+    """
+    This worker thread's short-range detector (threshold 0.3), built on first use.
+    Direct BlazeFace runs single-threaded here: the pool already spreads images over the cores.
+    """
+    detector = getattr(_train_local, "detector", None)
+    if detector is None:
+        direct = _direct_detector(0.3, num_threads=1)
+        if direct is not None:
+            detector = direct.process
+        else:
+            import mediapipe as mp
+            mp_face = mp.solutions.face_detection.FaceDetection(model_selection=0, min_detection_confidence=0.3)
+            detector = lambda rgb: mp_face.process(rgb).detections
+        _train_local.detector = detector
+    return detector
+
+def _training_patch(path, cache):
+    """
+    Worker: reads and hashes one dataset image and, on a cache miss, detects and crops the face.
+    Returns (hash, status, patch) with status "cached", "new" or "unreadable".
+    Each worker thread owns its own detector.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    h = hashlib.blake2b(data, digest_size=16).hexdigest()
+    if h in cache:
+        return h, "cached", None
+
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return h, "unreadable", None
+
+    detector = _training_detector()
+    # One BGR->RGB pass on the (downscaled) frame into a per-thread buffer; dataset images are
+    # usually all the camera's size, so it is rarely reallocated. crop_face grays only the crop.
+    small = downscale_for_detection(img)
+    rgb = getattr(_train_local, "rgb", None)
+    if rgb is None or rgb.shape != small.shape:
+        rgb = _train_local.rgb = np.empty_like(small)
+    detections = detector(cv2.cvtColor(small, cv2.COLOR_BGR2RGB, dst=rgb))
+    return h, "new", (crop_face(img, detections[0]) if detections else None)
+
 def train_model_background(dataset_dir, progress_callback=None):
     """
     Background task to scan dataset, extract embeddings, 
-    train RandomForest, and update the global status file.
+    fit the nearest-centroid matcher, and update the global status file.
     """
-    import mediapipe as mp
-    mp_face = mp.solutions.face_detection.FaceDetection(
-        model_selection=0, min_detection_confidence=0.3
-    )
-
     X, y = [], []
+    cache, old_index = load_embedding_cache()
+    index = {} # stat key -> content hash for every image present this run
+    seen = set()
+    dirty = False
+
+    # Get student folders (each folder name is a user_id) and their images
+    jobs = []
+    # scandir dirents carry the file type; images get one stat each (far cheaper than a read + hash)
+    with os.scandir(dataset_dir) as it:
+        student_dirs = [e for e in it if e.is_dir()]
+    for student in student_dirs:
+        with os.scandir(student.path) as it:
+            jobs += [(student.name, f.path, image_stat_key(f)) for f in it
+                     if f.is_file() and f.name.lower().endswith((".jpg", ".jpeg", ".png"))]
+    total_images = max(1, len(jobs))
+
+    # Files whose path, size and mtime match the last run are resolved from the index
+    # without being opened; only new or modified images are read, hashed and detected
+    unread = []
+    for user_id, path, key in jobs:
+        h = old_index.get(key)
+        if h not in cache:
+            unread.append((user_id, path, key))
+            continue
+        index[key] = h
+        seen.add(h)
+        if cache[h] is not None:
+            X.append(cache[h])
+            y.append(user_id)
+    done = len(jobs) - len(unread)
+    if progress_callback and done:
+        progress_callback(int((done / total_images) * 80), f"Processing Image {done}/{total_images}...")
 
-    # Get student folders (each folder name is a user_id)
-    student_dirs = [d for d in os.listdir(dataset_dir) if os.path.isdir(os.path.join(dataset_dir, d))]
-    total_students = max(1, len(student_dirs))
-    processed = 0
+    # New crops are normalized together once every image has been read
+    new_labels, new_hashes, new_patches = [], [], []
 
-    for user_id in student_dirs:
-        folder = os.path.join(dataset_dir, user_id)
-        files = [f for f in os.listdir(folder) if f.lower().endswith((".jpg", ".jpeg", ".png"))]
+    with ThreadPoolExecutor(max_workers=TRAIN_WORKERS) as pool:
+        futures = {pool.submit(_training_patch, path, cache): (user_id, key) for user_id, path, key in unread}
+        for done, future in enumerate(as_completed(futures), done + 1):
+            user_id, key = futures[future]
+            h, status, patch = future.result()
+            seen.add(h)
+            if status != "unreadable":
+                index[key] = h
 
-        for fn in files:
-            img = cv2.imread(os.path.join(folder, fn))
-            if img is None: continue
+            # Unchanged images reuse their embedding from the previous run
+            if status == "cached":
+                if cache[h] is not None:
+                    X.append(cache[h])
+                    y.append(user_id)
+            elif status == "new":
+                dirty = True
+                if patch is None:
+                    cache[h] = None
+                else:
+                    new_labels.append(user_id)
+                    new_hashes.append(h)
+                    new_patches.append(patch)
 
-            results = mp_face.process(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-            if not results.detections: continue
+            if progress_callback and (done % 10 == 0 or done == total_images):
+                # Scale 0-80% for image processing phase
+                pct = int((done / total_images) * 80)
+                progress_callback(pct, f"Processing Image {done}/{total_images}...")
 
-            # Extract feature vector
-            emb = crop_face_and_embed(img, results.detections[0])
-            if emb is not None:
-                X.append(emb)
-                y.append(user_id)
+    # Extract feature vectors for all new crops in one vectorized pass
+    if new_patches:
+        for h, user_id, emb in zip(new_hashes, new_labels, normalize_faces(new_patches)):
+            cache[h] = emb
+            X.append(emb)
+            y.append(user_id)
 
-        processed += 1
-        if progress_callback:
-            # Scale 0-80% for image processing phase
-            pct = int((processed / total_students) * 80)
-            progress_callback(pct, f"Processing Student {processed}/{total_students}...")
+    # Drop entries for images that were deleted since the last run
+    if dirty or len(seen) != len(cache) or index != old_index:
+        save_embedding_cache({h: cache[h] for h in seen if h in cache}, index)
 
     # Guard clause: No data
     if len(X) == 0:
@@ -150,23 +674,32 @@ def train_model_background(dataset_dir, progress_callback=None):
     if progress_callback:
         progress_callback(85, "Training AI Model...")
 
-    # Initialize and train classifier
-    clf = RandomForestClassifier(n_estimators=150, n_jobs=-1, random_state=42)
-    clf.fit(X, y)
+    # Fit PCA + one centroid per student
+    n_components = min(PCA_COMPONENTS, X.shape[0], X.shape[1])
+    clf = fit_centroid_model(X, y, n_components)
 
-    # Calculate metrics
+    # Calculate metrics (with one student every prediction is trivially right, so none is reported)
+    single = len(clf.classes_) < 2
     predictions = clf.predict(X)
     train_acc = accuracy_score(y, predictions)
 
     # Log to MLflow if an experiment is active
     if mlflow.active_run():
-        mlflow.log_metric("train_accuracy", float(train_acc))
-        mlflow.log_param("n_estimators", 150)
-        print(f"MLflow Logged: Accuracy {train_acc:.2%}")
+        if not single:
+            mlflow.log_metric("train_accuracy", float(train_acc))
+        mlflow.log_param("classifier", "nearest_centroid")
+        mlflow.log_param("pca_components", clf.components.shape[0])
+        if not single:
+            print(f"MLflow Logged: Accuracy {train_acc:.2%}")
 
-    # Save trained model to disk
-    with open(MODEL_PATH, "wb") as f:
-        pickle.dump(clf, f)
+    # Save trained model to disk (write-then-rename so readers never see a partial file)
+    tmp_path = MODEL_PATH + ".tmp"
+    clf.save(tmp_path)
+    os.replace(tmp_path, MODEL_PATH)
+    # Hand the fitted model straight to this process's recognition cache; nothing to re-read
+    with _clf_lock:
+        _clf_cache["clf"] = clf
+        _clf_cache["mtime"] = (MODEL_PATH, os.stat(MODEL_PATH).st_mtime)
 
     # --- CRITICAL: Update Status to Idle ---
     if progress_callback:
@@ -175,6 +708,7 @@ def train_model_background(dataset_dir, progress_callback=None):
     write_final_status({
         "running": False,
         "progress": 100,
-        "message": f"Complete! Accuracy: {train_acc:.2%}"
+        "message": ("Complete! 1 student enrolled (accuracy needs 2+)" if single
+                    else f"Complete! Accuracy: {train_acc:.2%}")
     })
     print("✅ Training Finished: Model saved and status file updated.")
\ No newline at end of file
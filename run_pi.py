@@ -1,19 +1,29 @@
-import threading, time, subprocess, os, cv2, numpy as np, mediapipe as mp
+import os
+# Must be set before NumPy/OpenCV/MediaPipe load: cap BLAS/OpenMP pools so they don't
+# spawn a thread per core and fight the camera thread and the web server for the CPU
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "2")
+os.environ.setdefault("OMP_NUM_THREADS", "2")
+os.environ.setdefault("MEDIAPIPE_DISABLE_GPU", "1") # No GPU delegate on the Pi; skip probing for one
+
+import io, queue, threading, time, subprocess, select, signal, cv2, numpy as np
 from unittest import result
 import socket, smtplib
 from email.message import EmailMessage
 from flask import Response, jsonify, request
-from app import app, db
-from hardware import attendance_success, attendance_duplicate, attendance_unknown, system_message, cleanup
-from model import load_model_if_exists, predict_with_model, crop_face_and_embed
+from app import app, db, get_user_name, load_user_names
+from hardware import notify, system_message, cleanup
+from model import load_model_if_exists, predict_batch_with_model, crop_face, normalize_faces, detect_faces, box_detection, EMBED_DIM
 from sqlalchemy import text
 from dotenv import load_dotenv
+from waitress import serve
 
 # --- INITIALIZATION ---
 load_dotenv() # Loads your .env file
 DATASET_DIR = "dataset"
-latest_frame = None
 system_state = "IDLE" 
+# A scan nobody completes ends on its own instead of keeping capture + detection running
+SCAN_TIMEOUT = 15.0
+scan_deadline = 0.0 # monotonic
 
 # Mapping your .env variables
 GMAIL_USER = os.getenv("GMAIL_USER")
@@ -96,82 +106,641 @@ def send_boot_report():
 
 # --- CAMERA & VIDEO LOGIC ---
 
-def get_pi_frame():
-    """Captures the absolute LATEST frame by forcing a flush and short timeout."""
-    cmd = [
+# Every colour conversion goes through cv2.cvtColor (SIMD kernels), never NumPy matrix maths;
+# make sure those kernels are on and warn if this OpenCV build has no NEON path
+cv2.setUseOptimized(True)
+cv2.setNumThreads(2) # Matches the two recognition cores below instead of one worker per core
+if os.uname().machine in ("aarch64", "armv7l") and not cv2.checkHardwareSupport(cv2.CPU_NEON):
+    print("[CAMERA] Warning: OpenCV built without NEON - colour conversion will be slow")
+
+FRAME_W, FRAME_H = 640, 480
+YUV_FRAME_SIZE = FRAME_W * FRAME_H * 3 // 2
+# Sensor rate: recognition needs 2 agreeing frames and the feed is capped at ~10 fps, so
+# 15 fps halves the per-frame copies/encodes of the default 30 without delaying a mark
+CAPTURE_FPS = 15
+# Dashboard MJPEG size when Picamera2 encodes it from the ISP's lores stream
+FEED_W, FEED_H = 320, 240
+FEED_JPEG_QUALITY = 80 # Python-side feed encode (no MJPEG encoder)
+# Studio-range Y (16-235, BT.601) -> full-range gray: what YUV2BGR_I420 followed by BGR2GRAY
+# gives, so crops taken from the Y plane match the grayscale of the saved training photos
+Y_TO_GRAY = np.clip(np.round((np.arange(256) - 16) * (255 / 219)), 0, 255).astype(np.uint8)
+
+# Optional libjpeg-turbo binding (needs libturbojpeg0 from apt): encodes the I420 planes directly
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+
+# Capture backends. Both expose read() -> CapturedFrame (None on failure) and close().
+try:
+    from picamera2 import Picamera2, MappedArray
+    from picamera2.encoders import MJPEGEncoder
+    from picamera2.outputs import FileOutput
+except ImportError:
+    Picamera2 = None
+
+class JpegFrameOutput(io.BufferedIOBase):
+    """Receives finished JPEGs from Picamera2's MJPEG encoder; keeps only the newest one."""
+    def __init__(self):
+        self.frame = None
+        self.condition = threading.Condition()
+
+    def write(self, buf):
+        with self.condition:
+            self.frame = bytes(buf) # No copy when the encoder already hands us bytes
+            self.condition.notify_all()
+
+class CapturedFrame:
+    """
+    One captured I420 frame, owned outright (safe to keep). Detection only needs .luma, a view of
+    the Y plane; .gray (face crops) and .bgr (snapshots, the imencode feed) are converted on first
+    use, so frames nobody looks at never pay for them. .jpeg() is encoded once per frame and
+    shared by every /video_feed client.
+    """
+    __slots__ = ("yuv", "luma", "_gray", "_bgr", "_jpeg")
+
+    def __init__(self, yuv):
+        self.yuv = yuv
+        self.luma = yuv[:FRAME_H]
+        self._gray = None
+        self._bgr = None
+        self._jpeg = None
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            # One table lookup over the Y plane instead of a full colour conversion
+            self._gray = cv2.LUT(self.luma, Y_TO_GRAY)
+        return self._gray
+
+    @property
+    def bgr(self):
+        if self._bgr is None:
+            # Two threads may race here; both produce the same image, so either result is fine
+            self._bgr = cv2.cvtColor(self.yuv, cv2.COLOR_YUV2BGR_I420)
+        return self._bgr
+
+    def jpeg(self):
+        """JPEG bytes for the dashboard feed; with libjpeg-turbo no BGR image is ever built."""
+        if self._jpeg is None:
+            # Same benign race as .bgr: two viewers woken by one frame may both encode it
+            if turbo_jpeg is not None:
+                self._jpeg = turbo_jpeg.encode_from_yuv(self.yuv, FRAME_H, FRAME_W, quality=FEED_JPEG_QUALITY,
+                                                        jpeg_subsample=TJSAMP_420)
+            else:
+                self._jpeg = cv2.imencode('.jpg', self.bgr, [cv2.IMWRITE_JPEG_QUALITY, FEED_JPEG_QUALITY])[1].tobytes()
+        return self._jpeg
+
+class Picamera2Backend:
+    """
+    One long-lived Picamera2 YUV420 stream (preferred). An MJPEG encoder is attached when possible;
+    jpeg_output is then set and /video_feed never calls cv2.imencode. The encoder only runs while
+    a feed client is connected (set_feed_active).
+    """
+    def __init__(self):
+        self.cam = Picamera2()
+        self.jpeg_output = None
+        self.encoder = None
+        self.encoding = False
+        try:
+            # 4 DMA buffers (default 6): enough for the ISP to stay a frame ahead of us, less CMA pinned.
+            # The ISP also scales a quarter-size lores copy for the MJPEG encoder, so the dashboard
+            # feed costs a quarter of the encode work and bandwidth of the analysed stream.
+            self.cam.configure(self.cam.create_video_configuration(
+                main={"size": (FRAME_W, FRAME_H), "format": "YUV420"},
+                lores={"size": (FEED_W, FEED_H), "format": "YUV420"},
+                encode="lores", buffer_count=4,
+                controls={"FrameRate": CAPTURE_FPS}
+            ))
+            self.cam.start()
+            try:
+                # The encoder runs alongside our own captures on the same stream, once started
+                self.encoder = MJPEGEncoder()
+                self.jpeg_output = JpegFrameOutput()
+            except Exception as e:
+                print(f"[CAMERA] MJPEG encoder unavailable ({e}) - video feed will encode in Python")
+        except Exception:
+            self.cam.close()
+            raise
+        print("[CAMERA] Picamera2 stream started")
+
+    def set_feed_active(self, active):
+        """Starts the MJPEG encoder for the first feed client and stops it after the last one leaves."""
+        if self.jpeg_output is None or active == self.encoding:
+            return
+        try:
+            if active:
+                self.cam.start_encoder(self.encoder, FileOutput(self.jpeg_output))
+            else:
+                self.cam.stop_encoder()
+                self.jpeg_output.frame = None # Don't show the next viewer a stale picture
+            self.encoding = active
+        except Exception as e:
+            print(f"[CAMERA] MJPEG encoder failed ({e}) - video feed will encode in Python")
+            self.jpeg_output = None
+
+    def reset(self):
+        """Soft-resets the stream in place (no process kill, no sudo). Returns True on success."""
+        try:
+            self.cam.stop()
+            self.cam.start()
+            print("[CAMERA] Picamera2 stream restarted")
+            return True
+        except Exception as e:
+            print(f"[CAMERA] Restart failed: {e}")
+            return False
+
+    def read(self):
+        for attempt in range(2):
+            try:
+                # One copy straight out of the mapped DMA buffer (no capture_array() allocation on top)
+                request = self.cam.capture_request()
+                try:
+                    with MappedArray(request, "main") as m:
+                        return CapturedFrame(m.array.copy())
+                finally:
+                    request.release()
+            except RuntimeError as e:
+                print(f"[CAMERA] Capture failed: {e}")
+                # One soft reset and retry; a second failure is left to the caller's back-off
+                if attempt or not self.reset():
+                    return None
+
+    def close(self):
+        try:
+            if self.encoding:
+                self.cam.stop_recording()
+            else:
+                self.cam.stop()
+        except Exception as e:
+            print(f"[CAMERA] Stop failed: {e}")
+
+class RpicamVidBackend:
+    """Fallback: one long-lived rpicam-vid streaming raw I420 frames over stdout."""
+    CMD = [
         "rpicam-vid", 
         "--nopreview", 
         "--camera", "0", 
-        "--width", "640", 
-        "--height", "480", 
-        "--frames", "1", 
-        "--timeout", "1",  # Minimal timeout to prevent lag buildup
-        "--flush",         # Force the camera to clear its internal buffer
+        "--width", str(FRAME_W), 
+        "--height", str(FRAME_H), 
+        "--framerate", str(CAPTURE_FPS),
+        "--timeout", "0",  # Run until we stop it
         "--codec", "yuv420", 
         "-o", "-"
     ]
-    
-    try:
-        # We add a 2-second subprocess timeout to ensure the script never hangs
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=2)
-        if not proc.stdout: return None
-        
-        expected_size = int(640 * 480 * 1.5)
-        raw = proc.stdout[:expected_size]
-        
-        if len(raw) < expected_size: return None
-        
-        yuv = np.frombuffer(raw, dtype=np.uint8).reshape((int(480 * 1.5), 640))
-        return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
-    except subprocess.TimeoutExpired:
-        print("[CAMERA] Timeout reading frame - skipping...")
-        return None
+    jpeg_output = None
+
+    def set_feed_active(self, active):
+        pass # No encoder; the feed encodes captured frames in Python
+
+    def __init__(self):
+        self.proc = None
+        # Consecutive failed starts/reads and when the next respawn is allowed (monotonic)
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def close(self):
+        """Kills the streaming rpicam-vid process directly (no sudo/pkill shell-out)."""
+        if self.proc is not None:
+            self.proc.kill()
+            try:
+                self.proc.wait(timeout=0.5)
+            except subprocess.TimeoutExpired:
+                pass
+            self.proc = None
+
+    def read(self):
+        """Reads the next frame, respawning rpicam-vid if it died or stalled."""
+        if self.proc is None or self.proc.poll() is not None:
+            if time.monotonic() < self.retry_at:
+                return None # Backing off; a missing camera must not become a fork/exec loop
+            self.proc = subprocess.Popen(self.CMD, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+
+        # The pipe is read straight into the frame's own array: no staging buffer, no copy
+        yuv = np.empty((FRAME_H * 3 // 2, FRAME_W), np.uint8)
+        view = memoryview(yuv).cast("B")
+        got = 0
+        while got < YUV_FRAME_SIZE:
+            # 2-second guard so the loop never hangs on a wedged camera
+            ready, _, _ = select.select([self.proc.stdout], [], [], 2)
+            n = self.proc.stdout.readinto(view[got:]) if ready else 0
+            if not n:
+                self.failures += 1
+                delay = min(30.0, 0.5 * 2 ** (self.failures - 1))
+                print(f"[CAMERA] rpicam-vid stalled or exited - restarting stream in {delay:.1f}s...")
+                self.retry_at = time.monotonic() + delay
+                self.close()
+                return None
+            got += n
+
+        self.failures = 0
+        return CapturedFrame(yuv)
+
+def open_camera():
+    """Returns the capture backend: Picamera2 if it imports and opens, else rpicam-vid."""
+    if Picamera2 is not None:
+        try:
+            return Picamera2Backend()
+        except Exception as e:
+            print(f"[CAMERA] Picamera2 unavailable ({e}) - using rpicam-vid fallback")
+    return RpicamVidBackend()
+
+camera = None
+
+def start_camera():
+    """Opens the camera backend once for the process."""
+    global camera
+    if camera is None:
+        camera = open_camera()
+        with active_clients_lock:
+            camera.set_feed_active(active_clients > 0) # A viewer may have connected before us
+    return camera
+
+def stop_camera():
+    """Stops the producer thread and releases the camera, if they were started."""
+    if frame_stream is not None:
+        frame_stream.stop()
+    if camera is not None:
+        camera.close()
+
+class FrameStream:
+    """
+    Producer thread that captures continuously and keeps only the newest frame (older ones are dropped).
+    Published CapturedFrames are never written to again, so readers can hold on to them safely.
+    """
+    def __init__(self, camera, wanted=lambda: True):
+        self.camera = camera
+        # Polled before each capture; while it is False no frames are pulled off the camera
+        self.wanted = wanted
+        self.frame = None
+        # Guards the slot and wakes /video_feed clients as soon as a new frame lands
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.update, daemon=True)
+        self.thread.start()
+        return self
+
+    def update(self):
+        paused = False
+        while not self.stopped:
+            if not self.wanted():
+                if not paused:
+                    with self.condition:
+                        self.frame = None # Don't hand out a stale frame when capture resumes
+                    paused = True
+                time.sleep(0.05) # Nobody is looking; let the ISP recycle its own buffers
+                continue
+            if paused:
+                # The backend may have held one frame (rpicam's blocked pipe) from before the pause
+                self.camera.read()
+                paused = False
+            frame = self.camera.read()
+            if frame is None:
+                time.sleep(0.1) # Camera hiccup; the backend has already logged it
+                continue
+            with self.condition:
+                self.frame = frame
+                self.condition.notify_all()
+
+    def read(self):
+        """Returns the newest CapturedFrame (None before the first one)."""
+        # Reading one attribute is atomic; the lock is only needed to wait for the next frame
+        return self.frame
+
+    def wait_for_frame(self, timeout=1.0):
+        """Blocks until the next capture is published and returns it (None on timeout)."""
+        with self.condition:
+            if not self.condition.wait(timeout):
+                return None
+            return self.frame
+
+    def stop(self, timeout=2.0):
+        """Stops capturing and waits (bounded) for an in-flight read, so the camera can be closed safely."""
+        self.stopped = True
+        thread = getattr(self, "thread", None)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+frame_stream = None
+
+# Open /video_feed responses. With none open, Picamera2's encoder is stopped and frames are
+# only captured while SCANNING; with the encoder feeding them, viewers need no captures at all
+active_clients = 0
+active_clients_lock = threading.Lock()
+
+def frames_wanted():
+    return system_state == "SCANNING" or (active_clients > 0 and getattr(camera, "jpeg_output", None) is None)
 
 @app.route('/video_feed')
 def video_feed():
     def stream():
+        global active_clients
+        with active_clients_lock:
+            active_clients += 1
+            if camera is not None and active_clients == 1:
+                camera.set_feed_active(True)
+        try:
+            yield from frames()
+        finally:
+            # Runs when the server closes the generator on client disconnect
+            with active_clients_lock:
+                active_clients -= 1
+                if camera is not None and not active_clients:
+                    camera.set_feed_active(False)
+
+    def frames():
         while True:
-            if latest_frame is not None:
-                _, buffer = cv2.imencode('.jpg', latest_frame)
-                yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-            time.sleep(0.1)
+            jpeg_output = getattr(camera, "jpeg_output", None)
+            if jpeg_output is not None:
+                # Encoded by Picamera2; just wait for the next one
+                with jpeg_output.condition:
+                    jpeg_output.condition.wait(timeout=1.0)
+                    jpeg = jpeg_output.frame
+                if jpeg is not None:
+                    yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+            elif frame_stream is not None:
+                # No encoder: wake on the next capture, so a frame is never encoded twice
+                frame = frame_stream.wait_for_frame(timeout=1.0)
+                if frame is not None:
+                    yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + frame.jpeg() + b'\r\n')
+            time.sleep(0.1) # Caps each client at ~10 fps (tunnel bandwidth), not a poll
     return Response(stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 # --- ATTENDANCE MODE LOGIC ---
 
+# Both URLs are rules on the one view (a single endpoint), not a forwarding wrapper
 @app.route('/trigger_capture')
+@app.route('/trigger_attendance')
 def trigger_capture():
-    global system_state
+    global system_state, scan_deadline
     app.enroll_id = request.args.get('student_id') 
+    scan_deadline = time.monotonic() + SCAN_TIMEOUT
     system_state = "SCANNING"
     return jsonify({"status": "capturing"})
 
-@app.route('/trigger_attendance')
-def trigger_attendance_alias():
-    return trigger_capture()
+@app.route('/cancel_capture')
+def cancel_capture():
+    """Ends a pending scan or enrollment capture (the page was closed or Stop was pressed)."""
+    global system_state
+    app.enroll_id = None
+    system_state = "IDLE"
+    return jsonify({"status": "cancelled"})
+
+# Local date string plus the monotonic time at which it expires (next local midnight)
+_today = ["", 0.0]
+
+def today_fast():
+    """Returns today's date as YYYY-MM-DD, reading the wall clock at most hourly and at midnight."""
+    now = time.monotonic()
+    if now >= _today[1]:
+        lt = time.localtime()
+        _today[0] = time.strftime("%Y-%m-%d", lt)
+        # Expire exactly at midnight, and at least hourly in case the clock is stepped (NTP after boot)
+        _today[1] = now + min(3600, 86400 - (lt.tm_hour * 3600 + lt.tm_min * 60 + lt.tm_sec))
+    return _today[0]
+
+# Built once: SQLAlchemy keys its compiled-statement cache on these objects, so the
+# hot path neither re-creates nor re-parses them
+MARKED_TODAY_SQL = text("SELECT student_id FROM attendance WHERE class_id = 1 AND timestamp >= CURDATE()")
+MARK_ATTENDANCE_SQL = text(
+    "INSERT IGNORE INTO attendance (student_id,class_id,timestamp,status) VALUES (:s,1,NOW(),'present')"
+)
+
+# Recognised (sid, name, conf) waiting to be written; bounded so a dead DB can't eat memory
+attendance_q = queue.Queue(maxsize=16)
+# Upper bound on marks folded into one INSERT: a full queue (e.g. after an outage) drains in one
+ATTENDANCE_BATCH = attendance_q.maxsize
+# Write attempts per mark before it is given up on (a row the DB will never accept)
+ATTENDANCE_RETRIES = 3
+
+def close_quietly(db_conn):
+    """Drops a connection after an error (server restart, wait_timeout...); the next write reconnects."""
+    if db_conn is not None:
+        try:
+            db_conn.close()
+        except Exception:
+            pass
+
+def requeue_marks(marks, error):
+    """Counts a failed attempt against each (sid, name, conf, tries) mark; returns those still worth retrying."""
+    retry = [(sid, name, conf, tries + 1) for sid, name, conf, tries in marks if tries + 1 < ATTENDANCE_RETRIES]
+    if retry:
+        print(f"[DB ERROR] {error} - retrying {len(retry)} mark(s)")
+    if len(retry) < len(marks):
+        print(f"[DB ERROR] {error} - dropping {len(marks) - len(retry)} mark(s)")
+    return retry
+
+def attendance_writer():
+    """
+    Single consumer for attendance marks: owns the DB connection and today's marked set,
+    and plays the success/duplicate feedback once the outcome is known.
+    """
+    app.app_context().push()
+    # Held for the thread's lifetime in autocommit mode: the INSERT IGNORE is the whole
+    # transaction, so a mark costs one round-trip (no pool checkout ping, no COMMIT)
+    db_conn = None
+    # Students already marked today, so repeat scans are answered without the DB
+    marked_today = set()
+    marked_date = None
+    # (sid, name, conf, tries) from a failed write, kept for another attempt instead of being dropped
+    retry = []
+
+    while True:
+        if retry:
+            time.sleep(1.0) # Give the server a moment before reconnecting
+            batch, retry = retry, []
+        else:
+            batch = [(*attendance_q.get(), 0)]
+        # Marks that queued up while the last write was in flight go out together
+        while len(batch) < ATTENDANCE_BATCH:
+            try:
+                batch.append((*attendance_q.get_nowait(), 0))
+            except queue.Empty:
+                break
+        today = today_fast()
+        try:
+            if db_conn is None:
+                db_conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+            if marked_date != today:
+                # New day (or after a DB error): reload who is already in today's register
+                marked_today = set(db_conn.execute(MARKED_TODAY_SQL).scalars())
+                marked_date = today
+        except Exception as e:
+            marked_date = None
+            close_quietly(db_conn)
+            db_conn = None
+            retry = requeue_marks(batch, e)
+            continue
+
+        # The set is the single duplicate check for the whole batch; repeats are answered
+        # here and never retried, so each one is announced once
+        fresh = {}
+        for mark in batch:
+            if mark[0] in marked_today or mark[0] in fresh:
+                notify("duplicate", mark[1]) # Known repeat; no DB round-trip
+            else:
+                fresh[mark[0]] = mark
+        if not fresh:
+            continue
+
+        # unique_attendance (student, class, day) rejects repeats, so one round-trip both
+        # checks and marks. New marks go out as a single multi-row INSERT; once a write has
+        # failed, marks are retried one row each so a row the DB rejects only sinks itself
+        marks = list(fresh.values())
+        if len(marks) > 1 and not any(tries for *_, tries in marks):
+            groups = [marks]
+        else:
+            groups = [[mark] for mark in marks]
+        for group in groups:
+            try:
+                if db_conn is None:
+                    db_conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+                if len(group) == 1:
+                    result = db_conn.execute(MARK_ATTENDANCE_SQL, {"s": group[0][0]})
+                else:
+                    result = db_conn.execute(MARK_ATTENDANCE_SQL, [{"s": mark[0]} for mark in group])
+            except Exception as e:
+                marked_date = None # The set may have missed a write; rebuild it next time
+                close_quietly(db_conn)
+                db_conn = None
+                retry += requeue_marks(group, e)
+                continue
+            marked_today.update(mark[0] for mark in group)
+
+            if len(group) == 1 and not result.rowcount:
+                notify("duplicate", group[0][1]) # LCD Duplicate Message
+            else:
+                # A multi-row rowcount can't say which row was ignored; either way
+                # every student in the group is now in today's register
+                for _, name, conf, _ in group:
+                    notify("success", name, conf) # LCD Success Message
+
+# Enrollment photos waiting for JPEG encode + disk write, off the camera thread
+photo_q = queue.Queue(maxsize=8)
+
+def photo_writer():
+    """Single consumer for enrollment captures: converts, encodes and saves each photo."""
+    while True:
+        img_path, frame, student_id = photo_q.get()
+        try:
+            # The captured frame owns its buffer, so colour conversion can happen here too
+            ok, jpg = cv2.imencode(".jpg", frame.bgr)
+            if not ok:
+                raise RuntimeError("JPEG encode failed")
+            with open(img_path, "wb") as f:
+                f.write(jpg)
+            notify("message", "Photo Captured", f"ID: {student_id}")
+        except Exception as e:
+            print(f"[ENROLL ERROR] {img_path}: {e}")
+
+# Recognition (camera thread plus the TFLite/OpenCV workers it starts) stays on the last two
+# cores so it isn't migrated around; web and writer threads stay unpinned, so a training run
+# can still use every core
+RECOGNITION_CPUS = {2, 3}
+
+def pin_current_thread(cpus):
+    """Restricts the calling thread, and threads it starts later, to cpus (skipped on smaller/non-Linux hosts)."""
+    try:
+        if (os.cpu_count() or 1) >= 4:
+            os.sched_setaffinity(0, cpus)
+    except (AttributeError, OSError):
+        pass
 
 def camera_loop():
-    global latest_frame, system_state
-    # Initialize MediaPipe Face Detection
-    mp_face = mp.solutions.face_detection.FaceDetection(model_selection=0, min_detection_confidence=0.5)
+    global system_state, frame_stream
+    # One app context for the thread's lifetime instead of a push/pop per detection
+    app.app_context().push()
+
+    # Before the detector is built: its 2 interpreter threads inherit this mask, so they get a
+    # core each instead of all sharing one with this thread
+    pin_current_thread(RECOGNITION_CPUS)
+    try:
+        os.nice(-5) # Needs CAP_SYS_NICE; harmless to skip
+    except (AttributeError, OSError):
+        pass
+
+    # MediaPipe comes from model.detect_faces(): one cached detector per config, shared process-wide
     clf = load_model_if_exists()
+    clf_checked = time.monotonic()
+    MODEL_CHECK_EVERY = 1.0 # seconds between model-file mtime checks while scanning
+    try:
+        load_user_names() # Warm the name cache now rather than on the first recognised face
+    except Exception as e:
+        print(f"[DB ERROR] Name cache preload failed: {e}")
     
     # --- MATCH TRACKING VARIABLES ---
     consecutive_matches = 0
     last_sid = None
+    streak_conf = 0.0 # Sum of the streak's confidences; the mark reports their mean
     REQUIRED_FRAMES = 2
+    # Gates on the cosine similarity to the best student's centroid (not a RandomForest
+    # probability); unrelated faces still score well above zero in PCA space, hence the higher bar
+    MATCH_CONF = 0.60      # counts towards the streak
+    NEAR_MISS_CONF = 0.45  # shown on the LCD as a near-miss
     
     # --- LCD FEEDBACK THROTTLING ---
     last_lcd_update = 0
     LCD_COOLDOWN = 1.5  # Seconds to keep a name on screen so it's readable
+
+    # BlazeFace sees a 128x128 letterboxed input, so 4:3 frames are shrunk once straight to the
+    # 128x96 it would use anyway; relative boxes still map onto the full frame
+    DETECT_W, DETECT_H = 128, 96
+    # Detection input comes from the Y plane: one resized channel, which direct BlazeFace
+    # spreads over RGB while letterboxing (face crops come from frame.gray, imwrite/imencode from frame.bgr)
+    small_buf = np.zeros((DETECT_H, DETECT_W), np.uint8)
+    # Embedding rows for the faces in one frame, reused every frame (more faces than this just allocate)
+    MAX_FACES = 8
+    emb_buf = np.empty((MAX_FACES, EMBED_DIM), np.float32)
+    # Build the shared detector now (graph/interpreter setup is the slow part), not on the first scan
+    detect_faces(small_buf, model_selection=0, min_conf=0.5)
+
+    # --- MOTION GATE (skip MediaPipe on an unchanged, empty scene) ---
+    gate_ref = None        # 80x60 luma thumbnail; only advanced when motion is seen
+    gate_had_face = True   # last analysed frame had a face (never skip while someone is there)
+    MOTION_THRESH = 4.0    # mean abs diff in gray levels
+    # --- DETECT-THEN-TRACK (reuse MediaPipe's boxes while the scene barely moves) ---
+    last_detections = None
+    frames_since_detect = 0
+    DETECT_EVERY = 5       # force a fresh MediaPipe pass at least every N analysed frames
+    TRACK_THRESH = 10.0    # mean abs diff above which the old boxes can't be trusted
+    # A single face on the move is followed by MOSSE on the 128x96 detection image instead of
+    # re-detected (a correlation filter update is a fraction of a BlazeFace pass); opencv-contrib only
+    make_tracker = getattr(getattr(cv2, "legacy", None), "TrackerMOSSE_create", None)
+    tracker = None
+    # --- RESULT REUSE (a still subject in a still frame gives the same answer again) ---
+    last_result = None     # (sid, conf, monotonic time) of the last real match
+    SAME_THRESH = 2.0      # mean abs diff below which the frame counts as unchanged
+    RESULT_TTL = 0.5       # seconds a match may be reused before it is recomputed
     
+    frame_stream = FrameStream(start_camera(), wanted=frames_wanted).start() # Capture runs ahead of us; we always take the newest frame
     system_message("System Online", "Ready")
     time.sleep(0.5)
 
+    prev_frame = None
     while True:
-        frame = get_pi_frame()
-        if frame is None: continue
-        latest_frame = frame.copy()
+        if system_state != "SCANNING":
+            # Boxes and tracker belong to the last scan's scene; the next one starts fresh
+            last_detections = tracker = None
+            time.sleep(0.05) # Idle work is trigger-driven; no need to look at frames
+            continue
+        if time.monotonic() > scan_deadline:
+            print("[CAMERA] Scan timed out")
+            app.enroll_id = None
+            system_state = "IDLE"
+            notify("message", "Scan Timed Out", "Please try again")
+            continue
+        frame = frame_stream.read()
+        if frame is None or frame is prev_frame:
+            # Already analysed this one: sleep until the camera publishes the next (no fixed sleeps,
+            # so the loop runs at camera rate and idles the rest of each frame interval)
+            frame = frame_stream.wait_for_frame(timeout=0.5)
+            if frame is None:
+                continue
+        prev_frame = frame
+        luma = frame.luma
 
         if system_state == "SCANNING":
             current_enrollment_id = getattr(app, 'enroll_id', None)
@@ -180,102 +749,160 @@ def camera_loop():
             if current_enrollment_id:
                 folder_path = os.path.join(DATASET_DIR, str(current_enrollment_id))
                 if not os.path.exists(folder_path): os.makedirs(folder_path)
-                img_path = os.path.join(folder_path, f"{int(time.time())}.jpg")
-                cv2.imwrite(img_path, frame)
-                
-                system_message("Photo Captured", f"ID: {current_enrollment_id}")
+                # ns timestamp: back-to-back triggers can't overwrite each other's photo
+                img_path = os.path.join(folder_path, f"{time.time_ns()}.jpg")
+                try:
+                    photo_q.put_nowait((img_path, frame, current_enrollment_id))
+                except queue.Full:
+                    print("[ENROLL] Photo writer backed up; capture dropped")
                 app.enroll_id = None 
-                system_state = "IDLE"
-                time.sleep(1.0) 
+                system_state = "IDLE" # The idle check at the loop top throttles it; no blocking pause needed
 
             # --- 2. ATTENDANCE MODE ---
             else:
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                results = mp_face.process(rgb_frame)
+                now = time.monotonic() # One clock read per pass, shared by the streak/LCD throttling below
+                if now - clf_checked >= MODEL_CHECK_EVERY:
+                    # mtime check at most once a second (not a stat per frame); still picks up a
+                    # freshly trained model without a restart
+                    clf = load_model_if_exists()
+                    clf_checked = now
+                # Every 8th luma pixel (4.8 KB) and one L1 norm: SAD with no resize or temporaries
+                gate = np.ascontiguousarray(luma[::8, ::8])
+                motion = None if gate_ref is None else cv2.norm(gate, gate_ref, cv2.NORM_L1) / gate.size
+                # Near-identical to the frame last analysed: its match still holds (no detect/embed/score)
+                reuse = (last_result is not None and motion is not None and motion < SAME_THRESH
+                         and now - last_result[2] < RESULT_TTL)
+                if reuse:
+                    detections = None
+                elif motion is not None and motion < MOTION_THRESH and not gate_had_face:
+                    detections = None # Same empty scene as last time; no face can have appeared
+                elif (last_detections and tracker is None and frames_since_detect < DETECT_EVERY
+                        and motion is not None and motion < TRACK_THRESH):
+                    # Small frame-to-frame change: the relative boxes still frame the same faces.
+                    # Not while tracking: MOSSE must see every frame, or its small search window
+                    # has to catch up on several frames of drift at once
+                    gate_ref = gate
+                    detections = last_detections
+                    frames_since_detect += 1
+                else:
+                    gate_ref = gate
+                    small_buf = cv2.resize(luma, (DETECT_W, DETECT_H), dst=small_buf, interpolation=cv2.INTER_AREA)
+                    tracked = False
+                    if tracker is not None and frames_since_detect < DETECT_EVERY:
+                        tracked, (x, y, w, h) = tracker.update(small_buf)
+                        if tracked:
+                            detections = last_detections = [
+                                box_detection(x / DETECT_W, y / DETECT_H, w / DETECT_W, h / DETECT_H)
+                            ]
+                            frames_since_detect += 1
+                    if not tracked:
+                        # Lost the face, or due a fresh pass: run the real detector
+                        detections = last_detections = detect_faces(small_buf, model_selection=0, min_conf=0.5)
+                        frames_since_detect = 0
+                        gate_had_face = bool(detections)
+                        tracker = None
+                        if make_tracker is not None and detections and len(detections) == 1:
+                            bb = detections[0].location_data.relative_bounding_box
+                            x1, y1 = max(0, int(bb.xmin * DETECT_W)), max(0, int(bb.ymin * DETECT_H))
+                            x2 = min(DETECT_W, int((bb.xmin + bb.width) * DETECT_W))
+                            y2 = min(DETECT_H, int((bb.ymin + bb.height) * DETECT_H))
+                            if x2 - x1 >= 8 and y2 - y1 >= 8:
+                                tracker = make_tracker()
+                                tracker.init(small_buf, (x1, y1, x2 - x1, y2 - y1))
                 found_match_this_frame = False
 
-                if results.detections and clf:
-                    emb = crop_face_and_embed(frame, results.detections[0])
-                    if emb is not None:
-                        sid, conf = predict_with_model(clf, emb)
-                        
-                        # Fetch user name from DB
-                        with app.app_context():
-                            result = db.session.execute(
-                                text("SELECT name FROM users WHERE user_id=:s"), {"s": sid}
-                            ).fetchone()
-                            # If found in DB, use name. If not found (newly added), show "New Student"
-                            name = result[0] if result else "New Student"
-
-                        # A. SUCCESS PATH (High Confidence + Streak)
-                        if conf > 0.35:
-                            found_match_this_frame = True
+                best = None
+                if reuse:
+                    best = last_result[:2]
+                else:
+                    last_result = None
+                    if detections and clf:
+                        patches = [p for p in (crop_face(frame.gray, d) for d in detections) if p is not None]
+                        if patches:
+                            # All faces become one (n, 1024) float32 matrix in a single normalize pass,
+                            # scored in one matrix product; follow the best match
+                            out = emb_buf[:len(patches)] if len(patches) <= MAX_FACES else None
+                            best = max(predict_batch_with_model(clf, normalize_faces(patches, out=out)), key=lambda m: m[1])
+                            last_result = (*best, now)
+
+                if best:
+                    sid, conf = best
+                    
+                    # Fetch user name (cached in app.py, DB only on a miss)
+                    # If found, use name. If not found (newly added), show "New Student"
+                    try:
+                        name = get_user_name(sid) or "New Student"
+                    except Exception as e:
+                        # A DB outage must not kill the camera thread; the miss is retried next frame
+                        print(f"[DB ERROR] Name lookup for {sid} failed: {e}")
+                        name = "New Student"
+
+                    # A. SUCCESS PATH (High Confidence + Streak)
+                    if conf > MATCH_CONF:
+                        found_match_this_frame = True
+                        # A reused result re-answers the same picture: it keeps the streak alive,
+                        # but only a fresh detect/embed/score pass counts as a vote
+                        if not reuse:
                             if sid == last_sid:
                                 consecutive_matches += 1
-                                print(f"[STREAK] {consecutive_matches}/3 for {name}")
+                                streak_conf += conf
+                                print(f"[STREAK] {consecutive_matches}/{REQUIRED_FRAMES} for {name}")
                             else:
                                 consecutive_matches = 1
+                                streak_conf = conf
                                 last_sid = sid
-                                
+                            
                             if consecutive_matches >= REQUIRED_FRAMES:
-                                with app.app_context():
-                                    # Check if already marked today
-                                    exists = db.session.execute(
-                                        text("SELECT 1 FROM attendance WHERE student_id=:s AND DATE(timestamp)=CURDATE()"),
-                                        {"s": sid}
-                                    ).fetchone()
-                                    
-                                    if not exists:
-                                        db.session.execute(
-                                            text("INSERT INTO attendance (student_id,class_id,timestamp,status) VALUES (:s,1,NOW(),'present')"),
-                                            {"s": sid}
-                                        )
-                                        db.session.commit()
-                                        attendance_success(name, conf) # LCD Success Message
-                                    else:
-                                        attendance_duplicate(name) # LCD Duplicate Message
-                                
+                                try:
+                                    # DB work happens on the writer thread; recognition carries on
+                                    attendance_q.put_nowait((sid, name, streak_conf / consecutive_matches))
+                                except queue.Full:
+                                    print(f"[DB ERROR] Attendance queue full - mark for {sid} dropped")
+                            
                                 # Reset for next person
                                 consecutive_matches = 0
                                 last_sid = None
+                                last_result = None
                                 system_state = "IDLE"
-                                last_lcd_update = time.time() # Prevent immediate overwrite
+                                last_lcd_update = now # Prevent immediate overwrite
 
-                        # B. FEEDBACK PATH (Near-misses shown on LCD)
-                        elif conf > 0.40 and (time.time() - last_lcd_update > LCD_COOLDOWN):
-                            # Adjusts to 16x2 display. Example: "Scanning... \n Nitesh 73%"
-                            system_message("Scanning...", f"{name[:10]} {int(conf*100)}%")
-                            last_lcd_update = time.time()
+                    # B. FEEDBACK PATH (Near-misses shown on LCD)
+                    elif conf > NEAR_MISS_CONF and (now - last_lcd_update > LCD_COOLDOWN):
+                        # Adjusts to 16x2 display. Example: "Scanning... \n Nitesh 73%"
+                        notify("message", "Scanning...", f"{name[:10]} {int(conf*100)}%")
+                        last_lcd_update = now
 
-                        # C. LOGGING (Always log rejections to console for debugging)
-                        if conf <= 0.50:
-                            print(f"[REJECTED] Low Conf: {name} ({conf:.2f})")
+                    # C. LOGGING (Always log rejections to console for debugging)
+                    if conf <= MATCH_CONF:
+                        print(f"[REJECTED] Low Conf: {name} ({conf:.2f})")
 
                 # If face is lost or no detection, reset the streak
                 if not found_match_this_frame:
                     consecutive_matches = 0
                     last_sid = None
 
-            # --- DYNAMIC SLEEP (Replace your old time.sleep(0.1) and (0.01) here) ---
-            if system_state == "SCANNING":
-                time.sleep(0.01) # Keep the loop tight during active use
-            else:
-                time.sleep(0.2)  # Save CPU while waiting for a trigger
-        
-        # This is the very last line of the while True loop
-        time.sleep(0.01)
-
 # --- MAIN RUN ---
 
+def _raise_keyboard_interrupt(signum, frame):
+    # start_system.py stops us with SIGTERM; unwind through the same path as Ctrl+C
+    raise KeyboardInterrupt
+
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
     try:
         # Boot Metrics and Report
         threading.Thread(target=send_boot_report, daemon=True).start()
         
-        # Camera Logic
+        # Attendance DB and photo writers, then Camera Logic
+        threading.Thread(target=attendance_writer, daemon=True).start()
+        threading.Thread(target=photo_writer, daemon=True).start()
         threading.Thread(target=camera_loop, daemon=True).start()
         
-        # Flask Dashboard
-        app.run(host="0.0.0.0", port=5000, use_reloader=False)
+        # Flask Dashboard (production WSGI server instead of the Werkzeug dev server)
+        serve(app, host="0.0.0.0", port=5000, threads=4)
     except KeyboardInterrupt:
+        pass
+    finally:
+        # Runs however serve() ends, so rpicam-vid/Picamera2 and the GPIO are always released
+        stop_camera()
         cleanup()
\ No newline at end of file
@@ -36,7 +36,10 @@ CREATE TABLE IF NOT EXISTS attendance (
 
     CONSTRAINT fk_student FOREIGN KEY (student_id) REFERENCES users(user_id) ON DELETE CASCADE,
     CONSTRAINT fk_class FOREIGN KEY (class_id) REFERENCES classes(class_id) ON DELETE CASCADE,
-    UNIQUE KEY unique_attendance (student_id, class_id, attendance_date)
+    UNIQUE KEY unique_attendance (student_id, class_id, attendance_date),
+
+    -- Range scans for the dashboard's 30-day chart
+    INDEX idx_attendance_timestamp (timestamp)
 );
 
 -- -----------------------------------------------------
@@ -1,3 +1,4 @@
+import os
 import subprocess
 import time
 import sys
@@ -21,9 +22,14 @@ def launch():
         print("\n🚀 SYSTEM ONLINE. Check your email for the link in a few seconds.")
         print("Press Ctrl+C to shut down all components.\n")
 
-        # Keep the script running while the processes are alive
-        while True:
-            time.sleep(1)
+        # Block in the kernel until either process exits (no polling), then stop the other one
+        pid, status = os.wait()
+        name = "Main AI System" if pid == app_proc.pid else "Cloudflare Bridge"
+        print(f"\n⚠️ {name} exited (code {os.waitstatus_to_exitcode(status)}). Shutting down system...")
+        for proc in (bridge_proc, app_proc):
+            if proc.pid != pid: # The exited one is already reaped
+                proc.terminate()
+                proc.wait()
 
     except KeyboardInterrupt:
         print("\n🛑 Shutting down system...")
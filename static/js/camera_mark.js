@@ -282,6 +282,9 @@ stopMarkBtn.addEventListener("click", () => {
         pollInterval = null;
     }
     
+    // Tell the Pi to stop scanning (fire-and-forget; the page reloads anyway)
+    fetch("/cancel_capture").catch(() => {});
+
     // Disconnect from camera stream
     markVideo.src = "";
     markVideo.style.display = "none";